@@ -7,7 +7,8 @@ CREATE TABLE users (
     email TEXT NOT NULL UNIQUE,
     password TEXT NOT NULL,
     created TIMESTAMP DEFAULT NOW(),
-    salt TEXT NOT NULL
+    salt TEXT NOT NULL,
+    retention INTERVAL --How long the user's events are kept, NULL uses the default retention in event_partition_settings
 );
 
 CREATE TABLE tokens (
@@ -15,6 +16,7 @@ CREATE TABLE tokens (
     user_id INT,
     name TEXT,
     token TEXT NOT NULL,
+    hash_version SMALLINT NOT NULL DEFAULT 1, --1: PBKDF2-SHA256, 2: HMAC-SHA256
 
     CONSTRAINT fk_user_id
       FOREIGN KEY(user_id) 
@@ -23,6 +25,10 @@ CREATE TABLE tokens (
 CREATE INDEX idx_token
 ON tokens(token);
 
+-- Tracks tokens still stored in the legacy format which are upgraded on their first successful use
+CREATE INDEX idx_legacy_token
+ON tokens(id) WHERE hash_version = 1;
+
 CREATE TABLE entity_types (
     id SERIAL PRIMARY KEY,
     name TEXT NOT NULL,
@@ -66,8 +72,7 @@ CREATE TABLE entity_instances (
     name TEXT,
     type INT,
     creator INT,
-    created TIMESTAMP DEFAULT NOW(),
-    modified TIMESTAMP DEFAULT NOW(),
+    created TIMESTAMP DEFAULT NOW(), --When the instance was last modified is the time of its latest event
 
     UNIQUE(creator,name),
 
@@ -80,17 +85,48 @@ CREATE TABLE entity_instances (
 	  REFERENCES entity_types(id)
 );
 
+-- Latest event of each entity instance so entity overviews never sort their events
+-- Inserts into events append their latest event per instance to entity_latest_deltas and compact_entity_latest_events
+-- folds them in, so events on the same instance never wait on its row
+CREATE TABLE entity_latest_events (
+    entity_id INT PRIMARY KEY,
+    event_id INT NOT NULL,
+    event_type INT,
+    time TIMESTAMP NOT NULL,
+    success BOOLEAN NOT NULL,
+
+    CONSTRAINT fk_entity_id
+      FOREIGN KEY(entity_id)
+	  REFERENCES entity_instances(id)
+);
+
+CREATE TABLE entity_latest_deltas (
+    creator INT NOT NULL,
+    entity_id INT NOT NULL,
+    event_id INT NOT NULL,
+    event_type INT,
+    time TIMESTAMP NOT NULL,
+    success BOOLEAN NOT NULL
+);
+
+CREATE INDEX idx_entity_latest_deltas_creator
+ON entity_latest_deltas(creator);
+
+-- Events are range partitioned on time so expired events are removed by dropping whole partitions
+-- The primary key must contain the partition key, ids remain unique as they come from a single sequence
 CREATE TABLE events (
-    id SERIAL PRIMARY KEY,
+    id SERIAL,
     type INT,
     creator INT NOT NULL,
     entity_id INT,
-    time TIMESTAMP DEFAULT NOW(),
+    time TIMESTAMP NOT NULL DEFAULT NOW(),
     success BOOLEAN NOT NULL,
-    rb_id INT, --Unused field, intended to hold the id of an event to rollback to in the implementation of a rollback feature
+    rb_id INT, --Unused field, intended to hold the id of an event to rollback to in the implementation of a rollback feature, checked by ingest_event as a partitioned table cannot reference itself by id alone
     notes TEXT,
     data JSONB, --{attr_name:value} --CHANGE TO ATTRIBUTES
 
+    PRIMARY KEY (id, time),
+
     CONSTRAINT fk_event_type
       FOREIGN KEY(type) 
 	  REFERENCES event_types(id),
@@ -101,17 +137,80 @@ CREATE TABLE events (
 
     CONSTRAINT fk_creator
       FOREIGN KEY(creator) 
-	  REFERENCES users(id),
+	  REFERENCES users(id)
+) PARTITION BY RANGE (time);
 
-    CONSTRAINT fk_rollback_id
-      FOREIGN KEY(rb_id) 
-	  REFERENCES events(id)
-);
+-- Holds events outside every partition, which maintain_event_partitions moves into a partition when it creates one for them
+CREATE TABLE events_default PARTITION OF events DEFAULT;
+
+--Event views page newest first by keyset on (time, id), these indexes make every page a range scan
 CREATE INDEX idx_entity_id
-ON events(entity_id);
+ON events(entity_id, time DESC, id DESC);
 
 CREATE INDEX idx_event_creator
-ON events(creator);
+ON events(creator, time DESC, id DESC);
+
+--Time ranges of one event type
+CREATE INDEX idx_event_creator_type
+ON events(creator, type, time DESC, id DESC);
+
+--Attribute filters match by containment, jsonb_path_ops keeps the index to hashes of paths to values
+CREATE INDEX idx_event_data
+ON events USING GIN(data jsonb_path_ops);
+
+--Events are appended in time order so a block range index serves time ranges across every user at little cost to inserts
+CREATE INDEX idx_event_time_brin
+ON events USING BRIN(time);
+
+-- Partitioning of events, a single row
+CREATE TABLE event_partition_settings (
+    id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+    partition_interval TEXT NOT NULL DEFAULT 'month' CHECK (partition_interval IN ('day', 'month')),
+    premake INT NOT NULL DEFAULT 3, --Partitions created ahead of the current one
+    retention INTERVAL, --How long events are kept for users without their own retention, NULL keeps them forever
+    drop_expired BOOLEAN NOT NULL DEFAULT TRUE --Expired partitions are dropped, otherwise they are only detached and kept as tables
+);
+INSERT INTO event_partition_settings DEFAULT VALUES;
+
+-- Partitions created by maintain_event_partitions and the time range each holds
+CREATE TABLE event_partitions (
+    name TEXT PRIMARY KEY,
+    range_start TIMESTAMP NOT NULL,
+    range_end TIMESTAMP NOT NULL,
+    detached BOOLEAN NOT NULL DEFAULT FALSE
+);
+
+CREATE TABLE journal_offsets (
+    journal_id TEXT PRIMARY KEY, --Identifier kept in the write-behind journal's directory
+    seq BIGINT NOT NULL --Highest journal record written to events
+);
+
+-- Counts of events per user, event type, entity type and success in each hour and each day, read by event stats
+-- Inserts into events append their counts to event_rollup_deltas and compact_event_rollups folds them into the rollups,
+-- so concurrent inserts never wait on the same rollup row
+CREATE TABLE event_rollups_hour (
+    creator INT NOT NULL,
+    bucket TIMESTAMP NOT NULL,
+    event_type INT,
+    entity_type INT,
+    success BOOLEAN NOT NULL,
+    events BIGINT NOT NULL,
+    UNIQUE NULLS NOT DISTINCT (creator, bucket, event_type, entity_type, success)
+);
+
+CREATE TABLE event_rollups_day (LIKE event_rollups_hour INCLUDING ALL);
+
+CREATE TABLE event_rollup_deltas (
+    creator INT NOT NULL,
+    bucket TIMESTAMP NOT NULL, --Hour the events fell in
+    event_type INT,
+    entity_type INT,
+    success BOOLEAN NOT NULL,
+    events BIGINT NOT NULL
+);
+
+CREATE INDEX idx_event_rollup_deltas_creator
+ON event_rollup_deltas(creator, bucket);
 
 -- Sets up the initial event types for modifying the entity event model
 CREATE PROCEDURE initalize_account(user_id INT)
@@ -167,6 +266,42 @@ BEGIN
 END; $$
 LANGUAGE plpgsql;
 
+-- Raises a foreign key violation unless the rollback id is null or an event of the same creator
+CREATE FUNCTION check_rollback_event(event_rb_id INT, event_creator INT) RETURNS VOID AS
+$$
+BEGIN
+    IF event_rb_id IS NOT NULL AND NOT EXISTS(SELECT 1 FROM events WHERE id = event_rb_id AND creator = event_creator) THEN
+        RAISE foreign_key_violation USING MESSAGE = format('rollback event %s does not exist', event_rb_id);
+    END IF;
+END; $$
+LANGUAGE PLPGSQL;
+
+-- Returns the id of an entity instance, creating it when first seen
+-- Known instances are only read, so events on the same instance never wait on its row
+CREATE FUNCTION resolve_entity_instance(entity_type INT, entity_name TEXT, event_creator INT) RETURNS INT AS
+$$
+DECLARE
+    instance_id INT;
+
+BEGIN
+    SELECT id INTO instance_id FROM entity_instances WHERE creator = event_creator AND name = entity_name;
+    IF FOUND THEN
+        RETURN instance_id;
+    END IF;
+
+    INSERT INTO entity_instances(type,name,creator)
+    VALUES(entity_type, entity_name, event_creator)
+    ON CONFLICT ON CONSTRAINT entity_instances_creator_name_key DO NOTHING
+    RETURNING id INTO instance_id;
+
+    -- Created by a concurrent transaction, which has committed once the insert returns
+    IF instance_id IS NULL THEN
+        SELECT id INTO instance_id FROM entity_instances WHERE creator = event_creator AND name = entity_name;
+    END IF;
+    RETURN instance_id;
+END; $$
+LANGUAGE PLPGSQL;
+
 -- TODO: Store information on the current state of the event for future referencing
 -- Adds a new event to event store and creates a new entity if it was not created already
 CREATE PROCEDURE new_event(
@@ -186,15 +321,222 @@ DECLARE
     new_event_entity_id INT;
 
 BEGIN
-	INSERT INTO entity_instances(type,name,creator)
-	VALUES(entity_id, entity_name, event_creator)
-	ON CONFLICT ON CONSTRAINT entity_instances_creator_name_key
-	DO UPDATE SET modified = NOW()
-	RETURNING id INTO new_event_entity_id;
+    PERFORM check_rollback_event(event_rb_id, event_creator);
+
+	new_event_entity_id := resolve_entity_instance(entity_id, entity_name, event_creator);
 
 	INSERT INTO events(type,entity_id,success,rb_id,data,creator,notes)
 	VALUES(event_id,new_event_entity_id,success,event_rb_id,event_data,event_creator,event_notes);
 END; $$
 LANGUAGE PLPGSQL;
 
+-- Validates an event against its creator's entity event model, keeps only the event type's attributes from the raw data,
+-- resolves the entity instance, creating it when first seen, and records the event in a single call
+-- Returns the id of the new event or NULL when the entity type cannot perform the event type
+CREATE FUNCTION ingest_event(
+    entity_type_name TEXT,
+    event_type_name TEXT,
+    entity_name TEXT,
+
+    event_creator INT,
+
+    success BOOLEAN,
+    event_rb_id INT,
+    event_notes TEXT,
+    raw_data JSONB
+) RETURNS INT AS
+$$
+DECLARE
+    valid_entity_type INT;
+    valid_event_type INT;
+    event_type_attrs TEXT[];
+    event_data JSONB;
+    new_event_entity_id INT;
+    new_event_id INT;
+
+BEGIN
+    SELECT entity_events.entity_type, entity_events.event_type, event_types.attrs
+    INTO valid_entity_type, valid_event_type, event_type_attrs
+    FROM entity_events
+    INNER JOIN entity_types ON entity_events.entity_type = entity_types.id
+    INNER JOIN event_types ON entity_events.event_type = event_types.id
+    WHERE entity_types.name = entity_type_name AND event_types.name = event_type_name
+    AND event_types.creator = event_creator AND entity_types.creator = event_creator;
+
+    IF NOT FOUND THEN
+        RETURN NULL;
+    END IF;
+
+    PERFORM check_rollback_event(event_rb_id, event_creator);
+
+    -- Attributes of the event type missing from the raw data are recorded as null
+    SELECT COALESCE(jsonb_object_agg(attr, raw_data -> attr), '{}')
+    INTO event_data
+    FROM unnest(event_type_attrs) AS attr;
+
+	new_event_entity_id := resolve_entity_instance(valid_entity_type, entity_name, event_creator);
+
+	INSERT INTO events(type,entity_id,success,rb_id,data,creator,notes)
+	VALUES(valid_event_type,new_event_entity_id,success,event_rb_id,event_data,event_creator,event_notes)
+	RETURNING id INTO new_event_id;
+
+    RETURN new_event_id;
+END; $$
+LANGUAGE PLPGSQL;
+
+-- Creates the current and upcoming partitions of events and removes partitions every user's retention has expired
+-- Run periodically by the server, concurrent runs wait for each other
+CREATE FUNCTION maintain_event_partitions() RETURNS VOID AS
+$$
+DECLARE
+    settings event_partition_settings%ROWTYPE;
+    step INTERVAL;
+    period_start TIMESTAMP;
+    period_end TIMESTAMP;
+    horizon TIMESTAMP;
+    partition_name TEXT;
+    longest_retention INTERVAL;
+    expired RECORD;
+    tenant RECORD;
+
+BEGIN
+    PERFORM pg_advisory_xact_lock(hashtext('maintain_event_partitions'));
+
+    SELECT * INTO settings FROM event_partition_settings;
+    step := ('1 ' || settings.partition_interval)::INTERVAL;
+
+    -- Partitions continue from the newest one so a change of interval never overlaps an existing partition
+    -- Periods missed while maintenance was not running are left in the default partition
+    period_start := date_trunc(settings.partition_interval, LOCALTIMESTAMP);
+    SELECT GREATEST(period_start, max(range_end)) INTO period_start FROM event_partitions WHERE NOT detached;
+    horizon := date_trunc(settings.partition_interval, LOCALTIMESTAMP) + step * (settings.premake + 1);
+
+    WHILE period_start < horizon LOOP
+        period_end := date_trunc(settings.partition_interval, period_start) + step;
+        partition_name := 'events_' || to_char(period_start, 'YYYYMMDD');
+
+        -- Events which fell into the default partition are moved before the new partition is attached
+        EXECUTE format('CREATE TABLE %I (LIKE events INCLUDING DEFAULTS)', partition_name);
+        EXECUTE format('WITH moved AS (DELETE FROM events_default WHERE time >= %L AND time < %L RETURNING *) INSERT INTO %I SELECT * FROM moved',
+            period_start, period_end, partition_name);
+        EXECUTE format('ALTER TABLE events ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)', partition_name, period_start, period_end);
+
+        INSERT INTO event_partitions(name, range_start, range_end) VALUES (partition_name, period_start, period_end);
+        period_start := period_end;
+    END LOOP;
+
+    -- Partitions are removed once older than the longest retention of any user, never while a user keeps events forever
+    SELECT CASE WHEN bool_or(COALESCE(retention, settings.retention) IS NULL) THEN NULL ELSE max(COALESCE(retention, settings.retention)) END
+    INTO longest_retention FROM users;
+
+    IF longest_retention IS NOT NULL THEN
+        FOR expired IN SELECT name FROM event_partitions WHERE NOT detached AND range_end <= LOCALTIMESTAMP - longest_retention LOOP
+            EXECUTE format('ALTER TABLE events DETACH PARTITION %I', expired.name);
+            IF settings.drop_expired THEN
+                EXECUTE format('DROP TABLE %I', expired.name);
+                DELETE FROM event_partitions WHERE name = expired.name;
+            ELSE
+                UPDATE event_partitions SET detached = TRUE WHERE name = expired.name;
+            END IF;
+        END LOOP;
+
+        DELETE FROM events_default WHERE time < LOCALTIMESTAMP - longest_retention;
+    END IF;
+
+    -- Users keeping events for less than the longest retention have their expired events deleted, a range scan of (creator, time)
+    FOR tenant IN SELECT id, COALESCE(retention, settings.retention) AS retention FROM users
+    WHERE COALESCE(retention, settings.retention) < longest_retention
+    OR (longest_retention IS NULL AND COALESCE(retention, settings.retention) IS NOT NULL) LOOP
+        DELETE FROM events WHERE creator = tenant.id AND time < LOCALTIMESTAMP - tenant.retention;
+    END LOOP;
+
+    -- Rollups are removed once every event they count has expired
+    DELETE FROM event_rollups_hour USING users WHERE event_rollups_hour.creator = users.id
+    AND bucket + INTERVAL '1 hour' <= LOCALTIMESTAMP - COALESCE(users.retention, settings.retention);
+    DELETE FROM event_rollups_day USING users WHERE event_rollups_day.creator = users.id
+    AND bucket + INTERVAL '1 day' <= LOCALTIMESTAMP - COALESCE(users.retention, settings.retention);
+END; $$
+LANGUAGE PLPGSQL;
+
+-- Appends the counts of the events inserted by a statement to event_rollup_deltas, one row per group rather than per event
+CREATE FUNCTION count_inserted_events() RETURNS TRIGGER AS
+$$
+BEGIN
+    INSERT INTO event_rollup_deltas(creator, bucket, event_type, entity_type, success, events)
+    SELECT inserted.creator, date_trunc('hour', inserted.time), inserted.type, entity_instances.type, inserted.success, count(*)
+    FROM inserted LEFT JOIN entity_instances ON entity_instances.id = inserted.entity_id
+    GROUP BY 1, 2, 3, 4, 5;
+    RETURN NULL;
+END; $$
+LANGUAGE PLPGSQL;
+
+CREATE TRIGGER count_inserted_events
+AFTER INSERT ON events
+REFERENCING NEW TABLE AS inserted
+FOR EACH STATEMENT EXECUTE FUNCTION count_inserted_events();
+
+-- Appends the newest event inserted by a statement for each entity instance to entity_latest_deltas
+CREATE FUNCTION track_latest_events() RETURNS TRIGGER AS
+$$
+BEGIN
+    INSERT INTO entity_latest_deltas(creator, entity_id, event_id, event_type, time, success)
+    SELECT DISTINCT ON (entity_id) creator, entity_id, id, type, time, success FROM inserted
+    WHERE entity_id IS NOT NULL
+    ORDER BY entity_id, time DESC, id DESC;
+    RETURN NULL;
+END; $$
+LANGUAGE PLPGSQL;
+
+CREATE TRIGGER track_latest_events
+AFTER INSERT ON events
+REFERENCING NEW TABLE AS inserted
+FOR EACH STATEMENT EXECUTE FUNCTION track_latest_events();
+
+-- Folds the pending deltas into the latest event of each entity instance, keeping whichever event is newer
+CREATE FUNCTION compact_entity_latest_events() RETURNS BIGINT AS
+$$
+DECLARE
+    compacted BIGINT;
+BEGIN
+    PERFORM pg_advisory_xact_lock(hashtext('entity_latest_events'));
+
+    WITH moved AS (DELETE FROM entity_latest_deltas RETURNING *)
+    INSERT INTO entity_latest_events(entity_id, event_id, event_type, time, success)
+    SELECT DISTINCT ON (entity_id) entity_id, event_id, event_type, time, success FROM moved
+    ORDER BY entity_id, time DESC, event_id DESC
+    ON CONFLICT (entity_id) DO UPDATE SET event_id = EXCLUDED.event_id, event_type = EXCLUDED.event_type, time = EXCLUDED.time, success = EXCLUDED.success
+    WHERE (EXCLUDED.time, EXCLUDED.event_id) > (entity_latest_events.time, entity_latest_events.event_id);
+    GET DIAGNOSTICS compacted = ROW_COUNT;
+    RETURN compacted;
+END; $$
+LANGUAGE PLPGSQL;
+
+-- Folds the pending deltas into the hourly and daily rollups, serialised with rebuilds by the same advisory lock
+CREATE FUNCTION compact_event_rollups() RETURNS BIGINT AS
+$$
+DECLARE
+    compacted BIGINT;
+BEGIN
+    PERFORM pg_advisory_xact_lock(hashtext('event_rollups'));
+
+    CREATE TEMPORARY TABLE compacted_deltas ON COMMIT DROP AS
+    WITH moved AS (DELETE FROM event_rollup_deltas RETURNING *)
+    SELECT creator, bucket, event_type, entity_type, success, sum(events) AS events FROM moved GROUP BY 1, 2, 3, 4, 5;
+    GET DIAGNOSTICS compacted = ROW_COUNT;
+
+    INSERT INTO event_rollups_hour(creator, bucket, event_type, entity_type, success, events)
+    SELECT * FROM compacted_deltas
+    ON CONFLICT (creator, bucket, event_type, entity_type, success) DO UPDATE SET events = event_rollups_hour.events + EXCLUDED.events;
+
+    INSERT INTO event_rollups_day(creator, bucket, event_type, entity_type, success, events)
+    SELECT creator, date_trunc('day', bucket), event_type, entity_type, success, sum(events) FROM compacted_deltas GROUP BY 1, 2, 3, 4, 5
+    ON CONFLICT (creator, bucket, event_type, entity_type, success) DO UPDATE SET events = event_rollups_day.events + EXCLUDED.events;
+
+    DROP TABLE compacted_deltas;
+    RETURN compacted;
+END; $$
+LANGUAGE PLPGSQL;
+
+SELECT maintain_event_partitions();
+
 COMMIT;
@@ -14,7 +14,12 @@ echo "[postgresql]
 host=database
 database=audit_logging
 user=postgres
-password=${DB_PASSWORD}" > ./src/database.ini
+password=${DB_PASSWORD}
+pool_min_size=1
+pool_max_size=10
+pool_idle_timeout=300
+pool_checkout_timeout=30
+pool_health_check_interval=30" > ./src/database.ini
 
 echo "Removing existing deployment..."
 docker-compose down
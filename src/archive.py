@@ -0,0 +1,276 @@
+"""
+Cold tier of events exported from old partitions into compressed segment files on local disk
+Event views read through the archive so history stays queryable after its partitions are dropped from the database
+"""
+
+import os
+import json
+import gzip
+import threading
+from datetime import datetime
+from psycopg2 import sql
+from utils import connect,disconnect,release
+
+
+"""
+Directory of segment files, one per archived partition, described by a manifest
+A segment holds one gzip member of newline delimited JSON events per user, ordered newest first, so reading a user's
+events seeks straight to their member. The manifest records each segment's time range and, per user, the member's
+byte range, event count and time range
+"""
+class Archive:
+    MANIFEST = 'manifest.json'
+    SEGMENT_SUFFIX = '.ndjson.gz'
+
+    def __init__(self, directory: str):
+        self._directory = directory
+        self._lock = threading.Lock()
+        self._segments = []
+        self._manifest_mtime = None
+        os.makedirs(directory, exist_ok=True)
+
+
+    """Segments newest first, the manifest is reloaded when another process has changed it"""
+    def segments(self) -> list:
+        path = os.path.join(self._directory, self.MANIFEST)
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return []
+
+        with self._lock:
+            if mtime != self._manifest_mtime:
+                with open(path) as file:
+                    segments = json.load(file)['segments']
+                for segment in segments:
+                    for key in ('range_start','range_end','min_time','max_time'):
+                        segment[key] = datetime.fromisoformat(segment[key])
+                    for tenant in segment['tenants'].values():
+                        tenant['min_time'] = datetime.fromisoformat(tenant['min_time'])
+                        tenant['max_time'] = datetime.fromisoformat(tenant['max_time'])
+                self._segments = sorted(segments, key=lambda segment: segment['range_start'], reverse=True)
+                self._manifest_mtime = mtime
+            return self._segments
+
+
+    """
+    Yields a user's archived events newest first as rows shaped like those of an event view
+    @param query: user, entity_name, from, to, cursor as (time, id), columns compared for equality, data attributes contained
+    and attributes filtered with operators
+    """
+    def events(self, query: dict):
+        user = str(query['user'])
+        for segment in self.segments():
+            tenant = segment['tenants'].get(user)
+            if tenant is None or not self._overlaps(tenant, query):
+                continue
+
+            with open(os.path.join(self._directory, segment['file']), 'rb') as file:
+                file.seek(tenant['offset'])
+                with gzip.GzipFile(fileobj=file, mode='rb') as member:
+                    for _ in range(tenant['events']):
+                        record = json.loads(member.readline())
+                        record['time'] = datetime.fromisoformat(record['time'])
+                        if self._matches(record, query):
+                            yield (record['id'],record['type'],record['entity_id'],record['time'].strftime('%d %b %Y %H:%M:%S'),
+                            record['success'],record['rb_id'],record['data'],record['time'])
+
+
+    """Whether a user's events in a segment can fall in the queried time range"""
+    @staticmethod
+    def _overlaps(tenant, query):
+        if query['from'] is not None and tenant['max_time'] < query['from']:
+            return False
+        if query['to'] is not None and tenant['min_time'] >= query['to']:
+            return False
+        if query['cursor'] is not None and tenant['min_time'] > query['cursor'][0]:
+            return False
+        return True
+
+
+    """Applies the filters of an event view to an archived event"""
+    @classmethod
+    def _matches(cls, record, query):
+        time = record['time']
+        if query['from'] is not None and time < query['from']:
+            return False
+        if query['to'] is not None and time >= query['to']:
+            return False
+        if query['cursor'] is not None and (time, record['id']) >= query['cursor']:
+            return False
+        if query['entity_name'] is not None and record['entity_name'] != query['entity_name']:
+            return False
+
+        for column,value in query['columns'].items():
+            if not cls._equals(record[column], value):
+                return False
+        for attr,value in query['data'].items():
+            if not cls._contains(record['data'] or {}, {attr:value}):
+                return False
+        for attr,operators in query['operators'].items():
+            if not cls._satisfies(record['data'] or {}, attr, operators):
+                return False
+        return True
+
+
+    """Applies the operators of an attribute filter the way the database does"""
+    @classmethod
+    def _satisfies(cls, data, attr, operators):
+        if 'in' in operators and not any(cls._contains(data, {attr:value}) for value in operators['in']):
+            return False
+
+        value = data.get(attr) if isinstance(data, dict) else None
+        if 'prefix' in operators and not (isinstance(value, str) and value.startswith(operators['prefix'])):
+            return False
+
+        comparisons = {'gte':lambda a,b: a >= b,'gt':lambda a,b: a > b,'lte':lambda a,b: a <= b,'lt':lambda a,b: a < b}
+        for operator,compare in comparisons.items():
+            if operator in operators:
+                if not isinstance(value, (int,float)) or isinstance(value, bool) or not compare(value, operators[operator]):
+                    return False
+        return True
+
+
+    """Equality the way the database compares a column with a value sent as a filter"""
+    @staticmethod
+    def _equals(stored, value):
+        if isinstance(stored, datetime):
+            try:
+                return stored == datetime.fromisoformat(str(value))
+            except ValueError:
+                return False
+        return str(stored).lower() == str(value).lower()
+
+
+    """JSONB containment, whether every part of contained is found in container"""
+    @classmethod
+    def _contains(cls, container, contained):
+        if isinstance(contained, dict):
+            return isinstance(container, dict) and all(key in container and cls._contains(container[key], value) for key,value in contained.items())
+        if isinstance(contained, list):
+            return isinstance(container, list) and all(any(cls._contains(item, value) for item in container) for value in contained)
+        if isinstance(contained, bool) or isinstance(container, bool):
+            return container is contained
+        return container == contained
+
+
+    """
+    Exports partitions of events whose range ended before the cutoff into segments and then drops them from the database
+    A partition already in the manifest, because a previous run stopped before dropping it, is only dropped
+    Returns the number of partitions archived
+    """
+    def archive_partitions(self, db_config: dict, older_than) -> int:
+        conn = None
+        try:
+            conn,cur = connect(db_config)
+            cur.execute("""SELECT name, range_start, range_end, detached FROM event_partitions
+            WHERE range_end <= LOCALTIMESTAMP - %s ORDER BY range_start""",(older_than,))
+            partitions = cur.fetchall()
+            conn.rollback()
+
+            archived = {segment['partition'] for segment in self.segments()}
+            for name,range_start,range_end,detached in partitions:
+                if name not in archived:
+                    self._export(conn, name, range_start, range_end)
+                self._drop(cur, name, detached)
+                conn.commit()
+
+            disconnect(conn,cur)
+            return len(partitions)
+        finally:
+            if conn is not None: release(conn)
+
+
+    """Writes a partition's events, with the names of their types and entities, into a new segment and adds it to the manifest"""
+    def _export(self, conn, name, range_start, range_end):
+        file_name = name+self.SEGMENT_SUFFIX
+        path = os.path.join(self._directory, file_name)
+        tenants = {}
+
+        cur = conn.cursor(name='archive_export')
+        cur.execute(sql.SQL("""SELECT e.id, e.type, event_types.name, e.creator, e.entity_id, entity_instances.name, e.time, e.success, e.rb_id, e.notes, e.data
+        FROM {0} AS e
+        LEFT JOIN event_types ON event_types.id = e.type
+        LEFT JOIN entity_instances ON entity_instances.id = e.entity_id
+        ORDER BY e.creator, e.time DESC, e.id DESC""").format(sql.Identifier(name)))
+
+        with open(path+'.tmp', 'wb') as file:
+            member = None
+            current = None
+            while True:
+                rows = cur.fetchmany(1000)
+                if not rows:
+                    break
+                for row in rows:
+                    creator = str(row[3])
+                    if creator != current:
+                        if member is not None:
+                            member.close()
+                            tenants[current]['length'] = file.tell()-tenants[current]['offset']
+                        current = creator
+                        tenants[current] = {'offset':file.tell(),'length':0,'events':0,'min_time':row[6],'max_time':row[6]}
+                        member = gzip.GzipFile(fileobj=file, mode='wb')
+
+                    record = {'id':row[0],'type':row[1],'type_name':row[2],'entity_id':row[4],'entity_name':row[5],'time':row[6].isoformat(),
+                    'success':row[7],'rb_id':row[8],'notes':row[9],'data':row[10]}
+                    member.write(json.dumps(record).encode()+b'\n')
+                    tenants[current]['events'] += 1
+                    tenants[current]['min_time'] = row[6]
+
+            if member is not None:
+                member.close()
+                tenants[current]['length'] = file.tell()-tenants[current]['offset']
+            file.flush()
+            os.fsync(file.fileno())
+        cur.close()
+        os.replace(path+'.tmp', path)
+
+        segment = {
+            'file':file_name,
+            'partition':name,
+            'range_start':range_start,
+            'range_end':range_end,
+            'min_time':min((tenant['min_time'] for tenant in tenants.values()), default=range_start),
+            'max_time':max((tenant['max_time'] for tenant in tenants.values()), default=range_start),
+            'events':sum(tenant['events'] for tenant in tenants.values()),
+            'tenants':tenants
+        }
+        self._add_segment(segment)
+
+
+    """Adds a segment to the manifest, replacing the manifest atomically"""
+    def _add_segment(self, segment):
+        path = os.path.join(self._directory, self.MANIFEST)
+        segments = []
+        if os.path.exists(path):
+            with open(path) as file:
+                segments = json.load(file)['segments']
+        segments.append(segment)
+
+        with open(path+'.tmp', 'w') as file:
+            json.dump({'segments':segments}, file, default=lambda value: value.isoformat())
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(path+'.tmp', path)
+
+
+    """Removes an archived partition from the database while partition maintenance is not running"""
+    @staticmethod
+    def _drop(cur, name, detached):
+        cur.execute("SELECT pg_advisory_xact_lock(hashtext('maintain_event_partitions'))")
+        if not detached:
+            cur.execute(sql.SQL("ALTER TABLE events DETACH PARTITION {0}").format(sql.Identifier(name)))
+        cur.execute(sql.SQL("DROP TABLE IF EXISTS {0}").format(sql.Identifier(name)))
+        cur.execute("DELETE FROM event_partitions WHERE name = %s",(name,))
+
+
+#Archive read by event views, None unless the server was started with an archive directory
+_archive = None
+
+def configure_archive(directory: str) -> Archive:
+    global _archive
+    _archive = Archive(directory)
+    return _archive
+
+def get_archive():
+    return _archive
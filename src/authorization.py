@@ -4,17 +4,28 @@
 import os
 import re
 import base64
+import hmac
 import hashlib
 import secrets
 
 from psycopg2 import DatabaseError
-from utils import connect,disconnect,DATABASE_ERROR
+from cache import LRUCache
+from utils import connect,disconnect,release,DATABASE_ERROR
 
 #TODO: Apply IP based filtering for account and token creation to prevent spamming, also utilize request quotas on a user basis
 
 class Authorizer:
     #Regex to ensure valid email format
     EMAIL_VALIDATION = re.compile(r'([A-Za-z0-9]+[.-_])*[A-Za-z0-9]+@[A-Za-z0-9-]+(\.[A-Z|a-z]{2,})+')
+
+    #Tokens which have already been verified mapped to the user they belong to, shared by every request in the process
+    _token_cache = LRUCache(int(os.getenv('TOKEN_CACHE_SIZE', 10000)), float(os.getenv('TOKEN_CACHE_TTL', 300)))
+
+    #Token hash formats stored in tokens.hash_version
+    #1: PBKDF2-SHA256 with 310000 iterations, only verified for tokens issued before version 2
+    #2: HMAC-SHA256, sufficient as tokens are 256 bit random values rather than passwords
+    LEGACY_TOKEN_HASH = 1
+    TOKEN_HASH = 2
     
 
     def __init__(self, type: str, key: str, db_config):
@@ -89,7 +100,7 @@ class Authorizer:
         except DatabaseError:
             return  DATABASE_ERROR,False,500 
         finally:
-            if conn is not None: conn.close()
+            if conn is not None: release(conn)
 
         return "{0} Registered".format(email),True,201
 
@@ -98,6 +109,15 @@ class Authorizer:
         return pw_hash == hashlib.pbkdf2_hmac('sha256', password.encode(), salt.encode(), 310000).hex()
 
 
+    """Hashes a token using the given hash format keyed by the TOKEN_SALT set on deployment"""
+    @staticmethod
+    def _hash_token(token: str, version: int) -> str:
+        salt = os.getenv('TOKEN_SALT')
+        if version == Authorizer.LEGACY_TOKEN_HASH:
+            return hashlib.pbkdf2_hmac('sha256', token.encode(), salt.encode(), 310000).hex()
+        return hmac.new(salt.encode(), token.encode(), hashlib.sha256).hexdigest()
+
+
     """Routes to the right authorization check based on type instatiated with"""
     def _authorize(self):
         if self.type=='Bearer':
@@ -112,51 +132,92 @@ class Authorizer:
     def generate_token(self, data):
         name = data.get('name') or ''
         token = secrets.token_urlsafe()
-
-        #Random salt, used to hash the token, stored in an environment variable set on deployment
-        salt = os.getenv('TOKEN_SALT')
-        token_hash = hashlib.pbkdf2_hmac('sha256', token.encode(), salt.encode(), 310000).hex()
+        token_hash = self._hash_token(token, self.TOKEN_HASH)
 
         conn = None
         try:
             conn,cur = connect(self._db_config)
-            cur.execute("INSERT INTO tokens(user_id,token,name) VALUES(%s,%s,%s)",(self._user,token_hash,name))            
+            cur.execute("INSERT INTO tokens(user_id,token,name,hash_version) VALUES(%s,%s,%s,%s)",(self._user,token_hash,name,self.TOKEN_HASH))            
             conn.commit()
             disconnect(conn,cur)
 
         except DatabaseError as error:
             raise Exception(DATABASE_ERROR,False,500)
         finally:
-            if conn is not None: conn.close()
+            if conn is not None: release(conn)
 
         response = {'mssg':"Token {0} created, will not be displayed again".format(name),'token':token}
         return response,True,201
 
 
+    """Fast digest of a presented token used as its cache key so the raw token is not kept in memory"""
+    @staticmethod
+    def _token_cache_key(token: str) -> bytes:
+        return hashlib.sha256(token.encode()).digest()
+
+    """Removes a single token from the verified token cache eg. when it is revoked"""
+    @classmethod
+    def invalidate_token(cls, token: str):
+        cls._token_cache.discard(cls._token_cache_key(token))
+
+    """Removes every cached token belonging to a user"""
+    @classmethod
+    def invalidate_user_tokens(cls, user_id):
+        cls._token_cache.discard_where(lambda cached_user: cached_user == user_id)
+
+    """Empties the verified token cache"""
+    @classmethod
+    def clear_token_cache(cls):
+        cls._token_cache.clear()
+
+
     """Checks if the token is valid and sets the user it belong to"""
     def _bearer_auth(self):
-        salt = os.getenv('TOKEN_SALT')
-        token_hash = hashlib.pbkdf2_hmac('sha256', self._key.encode(), salt.encode(), 310000).hex()
+        cache_key = self._token_cache_key(self._key)
+        user_id = self._token_cache.get(cache_key)
+        if user_id is not None:
+            self._set_authorized(user_id)
+            return
+
+        token_hash = self._hash_token(self._key, self.TOKEN_HASH)
 
         conn = None
         try:
             conn,cur=connect(self._db_config)
-            cur.execute("SELECT user_id FROM tokens WHERE token = %s",(token_hash,))
-            user = cur.fetchone()
+
+            #Looks up the token using the current format and whether any legacy hashed tokens remain in one round trip
+            cur.execute("""SELECT (SELECT user_id FROM tokens WHERE token = %s AND hash_version = %s),
+            EXISTS(SELECT 1 FROM tokens WHERE hash_version = %s)""",(token_hash,self.TOKEN_HASH,self.LEGACY_TOKEN_HASH))
+            user_id,legacy_remaining = cur.fetchone()
+            user = (user_id,) if user_id is not None else None
+
+            #Tokens issued before the current format are verified with the legacy hash and upgraded on first use
+            if user is None and legacy_remaining:
+                legacy_hash = self._hash_token(self._key, self.LEGACY_TOKEN_HASH)
+                cur.execute("""UPDATE tokens SET token = %s, hash_version = %s
+                WHERE token = %s AND hash_version = %s RETURNING user_id""",(token_hash,self.TOKEN_HASH,legacy_hash,self.LEGACY_TOKEN_HASH))
+                user = cur.fetchone()
+                conn.commit()
+
             disconnect(conn,cur)
 
         except DatabaseError:
             return
         finally:
-            if conn is not None: conn.close()
+            if conn is not None: release(conn)
 
         if user is None:
             self._code = 400
             return
 
+        self._token_cache.set(cache_key, user[0])
+        self._set_authorized(user[0])
+
+    """Marks the client as authorized as the given user"""
+    def _set_authorized(self, user):
         self._message = "Authorized"
         self._code = 200
-        self._user = user[0]
+        self._user = user
         self._authorized = True
 
 
@@ -181,7 +242,7 @@ class Authorizer:
         except DatabaseError:
             return
         finally:
-            if conn is not None: conn.close()
+            if conn is not None: release(conn)
 
         if user_details is None:
             self._message = "Unregistered Email"
@@ -190,8 +251,5 @@ class Authorizer:
         
         user,user_pw,salt=user_details[0],user_details[1],user_details[2]
         if self._is_correct_password(salt, user_pw, sent_pw):
-            self._message = "Authorized"
-            self._code = 200
-            self._user = user
-            self._authorized =  True
+            self._set_authorized(user)
 
@@ -0,0 +1,116 @@
+"""Thread safe in-process caches"""
+
+import time
+import threading
+from collections import OrderedDict
+
+
+"""Bounded least recently used cache where every entry expires a fixed number of seconds after it is stored"""
+class LRUCache:
+    def __init__(self, max_size: int, ttl: float):
+        self._max_size = max_size
+        self._ttl = ttl
+        self._entries = OrderedDict() #key: (value, expiry)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    """Returns the cached value for the key or the default if it is missing or expired"""
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+
+            value,expiry = entry
+            if expiry <= time.monotonic():
+                del self._entries[key]
+                return default
+
+            self._entries.move_to_end(key)
+            return value
+
+    """Stores the value, evicting the least recently used entry when full"""
+    def set(self, key, value):
+        if self._max_size <= 0:
+            return
+
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self._ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+
+    def discard(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    """Removes every entry whose value satisfies the predicate"""
+    def discard_where(self, predicate):
+        with self._lock:
+            for key in [key for key,(value,_) in self._entries.items() if predicate(value)]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+"""
+Least recently used cache bounded by the total size of its entries rather than their number
+Sizes are given by the caller, every entry expires a fixed number of seconds after it is stored
+"""
+class SizedLRUCache:
+    def __init__(self, max_bytes: int, ttl: float):
+        self._max_bytes = max_bytes
+        self._ttl = ttl
+        self._entries = OrderedDict() #key: (value, size, expiry)
+        self._bytes = 0
+        self._evictions = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    """Returns the cached value for the key or the default if it is missing or expired"""
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+
+            value,size,expiry = entry
+            if expiry <= time.monotonic():
+                del self._entries[key]
+                self._bytes -= size
+                return default
+
+            self._entries.move_to_end(key)
+            return value
+
+    """Stores the value, evicting least recently used entries until the cache fits, values larger than the cache are not stored"""
+    def set(self, key, value, size: int):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._bytes -= entry[1]
+            if size > self._max_bytes:
+                return
+
+            self._entries[key] = (value, size, time.monotonic() + self._ttl)
+            self._bytes += size
+            while self._bytes > self._max_bytes:
+                _,(_,evicted,_) = self._entries.popitem(last=False)
+                self._bytes -= evicted
+                self._evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    """Entries held, their total size, the size they are bounded by and the entries evicted to make room so far"""
+    def usage(self) -> dict:
+        with self._lock:
+            return {'entries':len(self._entries),'bytes':self._bytes,'max_bytes':self._max_bytes,'evictions':self._evictions}
@@ -1,13 +1,84 @@
 """Events class which manages the adding and removal of events"""
+import os
+import re
 import json
-from psycopg2 import DatabaseError
-from utils import connect,disconnect,label_rows,DATABASE_ERROR
+import math
+import heapq
+import base64
+import itertools
+import collections
+import binascii
+import contextlib
+from datetime import datetime,timedelta
+from psycopg2 import DatabaseError, DataError, Error
+from psycopg2.extras import execute_values
+from schema import SchemaCache
+from cache import LRUCache
+from groupcommit import get_group_committer
+from archive import get_archive
+from unitofwork import UnitOfWork
+from querycache import get_query_cache
+from utils import connect,disconnect,release,label_rows,DATABASE_ERROR
 
 
 class Event():
+    #Largest number of events accepted in a single batch
+    MAX_BATCH_SIZE = 10000
+
+    #Labels of the event details returned by views
+    EVENT_LABELS = ['event.id','event.type','entity_id','time','success','rb_id','attributes']
+
+    #Relative time range bounds such as "last 24h" and the unit each letter stands for
+    RELATIVE_TIME = re.compile(r'last\s*(\d+)\s*([smhdw])')
+    TIME_UNITS = {'s':'seconds','m':'minutes','h':'hours','d':'days','w':'weeks'}
+
+    #Operators an attribute filter may be given instead of a value, comparisons apply to numbers
+    ATTRIBUTE_COMPARISONS = {'gte':'>=','gt':'>','lte':'<=','lt':'<'}
+    ATTRIBUTE_OPERATORS = ('in','prefix')+tuple(ATTRIBUTE_COMPARISONS)
+
+    #Labels of the entity instance details returned by views and the filters accepted with the column each compares
+    ENTITY_LABELS = ['id','name','type','created','modified','latest_event.id','latest_event.type','latest_event.time','latest_event.success']
+    ENTITY_FILTERS = {'type':'entity_instances.type','name':'entity_instances.name',
+    'latest_event.type':'latest_events.event_type','latest_event.success':'latest_events.success'}
+
+    #Events returned per page of a view when no limit is sent and the largest limit accepted
+    DEFAULT_PAGE_SIZE = 1000
+    MAX_PAGE_SIZE = 10000
+
+    #Event details stats can be grouped by with the column holding each, the time buckets counts can be split into
+    #and the most groups returned
+    STAT_GROUPS = {'event_type':'events.type','entity_type':'entity_instances.type','entity':'events.entity_id','success':'success'}
+    STAT_BUCKETS = ('minute','hour','day')
+    MAX_STAT_GROUPS = 10000
+
+    #Groups and filters of stats which the hourly and daily rollups of events can answer, with the rollup column of each filter
+    ROLLUP_GROUPS = ('event_type','entity_type','success')
+    ROLLUP_FILTERS = {'events.type':'event_type','success':'success'}
+
+    #Ids of entity instances by (user, name), instances are never removed so entries only expire to bound memory
+    _instance_cache = LRUCache(int(os.getenv('ENTITY_CACHE_SIZE', 100000)), float(os.getenv('ENTITY_CACHE_TTL', 3600)))
+
     def __init__(self, db_config, user):
         self._db_config = db_config
         self._user = user
+        self._work = None
+
+    """Runs the enclosed changes and every event added meanwhile in one transaction on one pooled connection"""
+    @contextlib.contextmanager
+    def _unit_of_work(self):
+        with UnitOfWork(self._db_config) as work:
+            self._work = work
+            work.on_commit(self._written)
+            try:
+                yield work
+            finally:
+                self._work = None
+
+    """Makes the user's cached event views stale, called once events added by them have committed"""
+    def _written(self):
+        query_cache = get_query_cache()
+        if query_cache is not None:
+            query_cache.bump(self._user)
 
     #TODO: Add type validation as well
 
@@ -31,118 +102,797 @@ class Event():
         INVARIATE_ATTRS.extend(['rollback_id', 'notes'])
         invariate_attrs = {attr:attrs.get(attr) for attr in INVARIATE_ATTRS}
 
+        #Events naming an entity type and event type pair absent from a cached entity event model are rejected without a database call
+        model = SchemaCache.peek(self._user)
+        if model is not None:
+            self._validate_event_parameter(model.get((attrs['entity_type'], attrs['event_type'])),"Invalid Name(s) Received")
+
+        params = (
+            invariate_attrs['entity_type'],
+            invariate_attrs['event_type'],
+            invariate_attrs['entity_name'],
+            self._user,
+            invariate_attrs['success'],
+            invariate_attrs['rollback_id'],
+            invariate_attrs['notes'],
+            json.dumps(attrs)
+        )
+
+        #Events added within a unit of work commit with it, others share one transaction when group commit is enabled
+        group_committer = get_group_committer()
+        if self._work is not None:
+            try:
+                self._work.cursor.execute('SELECT ingest_event(%s,%s,%s,%s,%s,%s,%s,%s)',params)
+                event_id = self._work.cursor.fetchone()[0]
+            except DatabaseError:
+                raise Exception(DATABASE_ERROR,False,500)
+        elif group_committer is not None:
+            try:
+                event_id = group_committer.submit(params)
+            except DatabaseError:
+                raise Exception(DATABASE_ERROR,False,500)
+        else:
+            event_id = self._ingest(params)
+
+        self._validate_event_parameter(event_id,"Invalid Name(s) Received")
+        if self._work is None:
+            self._written()
+        
+        #TODO: A more descriptive message should be returned, including details of the attributes
+
+        return ('{0} event occured on {1} instance {2}').format(attrs['event_type'],attrs['entity_type'],attrs['entity_name']),True,201
+
+    """Validates the event, projects its variate attributes and records it in one round trip, returning its id or None for invalid names"""
+    def _ingest(self, params: tuple):
         conn = None
         try:
-            #Ensures the event can occur on the entity 
             conn,cur = connect(self._db_config)
-            cur.callproc('validate_event', (attrs['entity_type'], attrs['event_type'], self._user))
-            results = cur.fetchone()
+            cur.execute('SELECT ingest_event(%s,%s,%s,%s,%s,%s,%s,%s)',params)
+            event_id = cur.fetchone()[0]
+            conn.commit()
+            disconnect(conn,cur)
 
-            self._validate_event_parameter(results,"Invalid Name(s) Received")
-            entity_id,event_id = results[0],results[1]
-            self._validate_event_parameter(entity_id or event_id,"Invalid Event ({0}) on Entity ({1})".format(attrs['event_type'],attrs['entity_type'])) #TODO: Ensure that this is a necessary check
-        
-            #Collect the event type's variate attriibutes
-            cur.execute("SELECT attrs FROM event_types WHERE id = %s",(event_id,))
-            event_type_attrs = list(cur.fetchone()[0] or [])
-            variate_attrs = {attr:attrs.get(attr) for attr in event_type_attrs}
-
-            #Execute the event
-            cur.execute(
-            'CALL new_event(%s,%s,%s,%s,%s,%s,%s,%s)',
-            (
-                event_id,
-                entity_id,
-                invariate_attrs['entity_name'],
-                self._user,
-                invariate_attrs['success'],
-                invariate_attrs['rollback_id'],
-                invariate_attrs['notes'],
-                json.dumps(variate_attrs)
-            ))
+        except DatabaseError:
+            raise Exception(DATABASE_ERROR,False,500)
+        finally:
+            if conn is not None: release(conn)
+        return event_id
+
+    """
+    Validates an event and appends it to the write-behind journal instead of the event store
+    The event is durable once this returns and is written to the event store in the background
+    """
+    def add_async(self, attrs: dict, journal):
+        mssg = self._batch_event_error(attrs)
+        if mssg is not None:
+            raise Exception(mssg,False,400)
+
+        model = self._model()
+        self._validate_event_parameter(model.get((attrs['entity_type'], attrs['event_type'])),"Invalid Name(s) Received")
+
+        if not journal.append(self._user, attrs):
+            raise Exception("Event Queue Full",False,503)
+
+        return ('{0} event accepted for {1} instance {2}').format(attrs['event_type'],attrs['entity_type'],attrs['entity_name']),True,202
+
+    """Returns the user's entity event model, from the cache when it is there"""
+    def _model(self) -> dict:
+        model = SchemaCache.peek(self._user)
+        if model is None:
+            conn = None
+            try:
+                conn,cur = connect(self._db_config)
+                model = SchemaCache.get(cur, self._user)
+                disconnect(conn,cur)
+
+            except DatabaseError:
+                raise Exception(DATABASE_ERROR,False,500)
+            finally:
+                if conn is not None: release(conn)
+        return model
+
+    """Checks the mandatory attributes and types of an event in a batch, returning an error message if it is invalid"""
+    @staticmethod
+    def _batch_event_error(attrs):
+        if not isinstance(attrs, dict) or not all(key in attrs for key in ['event_type','entity_type','success','entity_name']):
+            return 'Missing Mandatory Event Parameter(s)'
+        if not all(isinstance(attrs[key], str) for key in ['event_type','entity_type','entity_name']):
+            return 'Event Type, Entity Type and Entity Name must be strings'
+        if not isinstance(attrs['success'], bool):
+            return 'Success must be true or false'
+        if attrs.get('rollback_id') is not None and (isinstance(attrs['rollback_id'], bool) or not isinstance(attrs['rollback_id'], int)):
+            return 'Rollback ID must be an integer'
+        if attrs.get('notes') is not None and not isinstance(attrs['notes'], str):
+            return 'Notes must be a string'
+        return None
+
+
+    """
+    Validates a batch of events and adds every valid event to the event store in a single transaction
+    Accepts a list of events or an object with the list under 'events' and reports the outcome of each event
+    """
+    def add_batch(self, data):
+        events = data.get('events') if isinstance(data, dict) else data
+
+        if not isinstance(events, list) or len(events) == 0:
+            raise Exception("Events must be sent as a non empty list",False,400)
+        if len(events) > self.MAX_BATCH_SIZE:
+            raise Exception("A batch can contain at most {0} events".format(self.MAX_BATCH_SIZE),False,400)
+
+        conn = None
+        try:
+            conn,cur = connect(self._db_config)
+            report = self._insert_batch(cur, events)
             conn.commit()
             disconnect(conn,cur)
 
         except DatabaseError:
             raise Exception(DATABASE_ERROR,False,500)
         finally:
-            if conn is not None: conn.close()
-        
-        #TODO: A more descriptive message should be returned, including details of the attributes
+            if conn is not None: release(conn)
 
-        return ('{0} event occured on {1} instance {2}').format(attrs['event_type'],attrs['entity_type'],attrs['entity_name']),True,201
-        
-    #TODO: For longterm viability and managing of the results, all views should be paginated and have the option to be ordered by an attribute
+        added = sum(item['success'] for item in report)
+        if added:
+            self._written()
+        code = 201 if added == len(events) else 207 if added > 0 else 400
+        return {'events_received':len(events),'events_added':added,'events':report},added == len(events),code
 
-    """View all the event's details, can be filtered by a specific entity or by a list of attributes"""
-    def view(self, filters, entity_name : str=None):
-        events = []
-        count = 0
+
+    """
+    Validates a list of events and inserts every valid one using the given cursor without committing
+    Returns the outcome of each event in the order received
+    """
+    def _insert_batch(self, cur, events: list) -> list:
+        report = [{'index':index,'success':False,'code':400,'result':self._batch_event_error(attrs)} for index,attrs in enumerate(events)]
+        candidates = [index for index,item in enumerate(report) if item['result'] is None]
+
+        #Entity type and event type pairs the user's entities can perform
+        model = SchemaCache.get(cur, self._user) if candidates else {}
+
+        #Rollback IDs must refer to existing events of the same user
+        rollback_ids = list({events[index]['rollback_id'] for index in candidates if events[index].get('rollback_id') is not None})
+        known_rollback_ids = set()
+        if rollback_ids:
+            cur.execute("SELECT id FROM events WHERE creator = %s AND id = ANY(%s)",(self._user,rollback_ids))
+            known_rollback_ids = {row[0] for row in cur.fetchall()}
+
+        valid = []
+        for index in candidates:
+            attrs = events[index]
+            if (attrs['entity_type'],attrs['event_type']) not in model:
+                report[index]['result'] = "Invalid Name(s) Received"
+            elif attrs.get('rollback_id') is not None and attrs['rollback_id'] not in known_rollback_ids:
+                report[index]['result'] = "Invalid Rollback ID"
+            else:
+                valid.append(index)
+
+        if valid:
+            #Resolves each entity instance once, the first event naming a new instance decides its type
+            instances = {}
+            for index in valid:
+                instances.setdefault(events[index]['entity_name'], model[(events[index]['entity_type'],events[index]['event_type'])][0])
+
+            instance_ids = self._instance_ids(cur, instances)
+
+            rows = []
+            for index in valid:
+                attrs = events[index]
+                _,event_id,event_type_attrs = model[(attrs['entity_type'],attrs['event_type'])]
+                variate_attrs = {attr:attrs.get(attr) for attr in event_type_attrs}
+                rows.append((event_id,instance_ids[attrs['entity_name']],attrs['success'],attrs.get('rollback_id'),json.dumps(variate_attrs),self._user,attrs.get('notes')))
+
+            event_ids = execute_values(cur,
+            "INSERT INTO events(type,entity_id,success,rb_id,data,creator,notes) VALUES %s RETURNING id",
+            rows, page_size=len(rows), fetch=True)
+
+            for index,(event_id,) in zip(valid,event_ids):
+                attrs = events[index]
+                report[index].update({'success':True,'code':201,'id':event_id,
+                'result':'{0} event occured on {1} instance {2}'.format(attrs['event_type'],attrs['entity_type'],attrs['entity_name'])})
+
+        return report
+
+
+    """
+    Returns the ids of the named entity instances, creating those seen for the first time
+    Ids of committed instances are cached so events on known instances neither query nor lock entity_instances
+    @param instances: {name: entity type id}
+    """
+    def _instance_ids(self, cur, instances: dict) -> dict:
+        ids = {}
+        for name in instances:
+            instance_id = self._instance_cache.get((self._user,name))
+            if instance_id is not None:
+                ids[name] = instance_id
+
+        missing = [name for name in instances if name not in ids]
+        if missing:
+            cur.execute("SELECT name, id FROM entity_instances WHERE creator = %s AND name = ANY(%s)",(self._user,missing))
+            for name,instance_id in cur.fetchall():
+                ids[name] = instance_id
+                self._instance_cache.set((self._user,name), instance_id)
+
+        #Instances created here are only cached once read again after their transaction has committed
+        new = [(instances[name],name,self._user) for name in missing if name not in ids]
+        if new:
+            ids.update(execute_values(cur,
+            """INSERT INTO entity_instances(type,name,creator) VALUES %s
+            ON CONFLICT ON CONSTRAINT entity_instances_creator_name_key DO NOTHING
+            RETURNING name,id""",
+            new, page_size=len(new), fetch=True))
+
+            #Instances created by a concurrent transaction, which has committed once the insert returns
+            concurrent = [name for _,name,_ in new if name not in ids]
+            if concurrent:
+                cur.execute("SELECT name, id FROM entity_instances WHERE creator = %s AND name = ANY(%s)",(self._user,concurrent))
+                ids.update(cur.fetchall())
+        return ids
+
+
+    """Encodes the position after an event as an opaque cursor"""
+    @staticmethod
+    def _encode_cursor(time: datetime, event_id: int) -> str:
+        return base64.urlsafe_b64encode(json.dumps([time.isoformat(),event_id]).encode()).decode()
+
+    """Decodes a cursor into the time and id of the last event of the previous page"""
+    @staticmethod
+    def _decode_cursor(cursor: str):
+        try:
+            time,event_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+            if not isinstance(event_id, int): raise ValueError
+            time = datetime.fromisoformat(time)
+            if time.tzinfo is not None: raise ValueError
+            return time,event_id
+        except (TypeError, ValueError, AttributeError, UnicodeDecodeError, binascii.Error):
+            raise Exception("Invalid Cursor",False,400)
+
+
+    """Key ordering the rows of an event view, newest first when reversed"""
+    @staticmethod
+    def _row_order(row):
+        return (row[7],row[0])
+
+
+    """Reads the limit from a view's filters, returning the default when none is sent"""
+    def _view_limit(self, filters: dict, default):
+        limit = filters.pop('limit', default)
+        if limit is not None and (not isinstance(limit, int) or isinstance(limit, bool) or not 1 <= limit <= self.MAX_PAGE_SIZE):
+            raise Exception("Limit must be an integer between 1 and {0}".format(self.MAX_PAGE_SIZE),False,400)
+        return limit
+
+
+    """
+    Reads a time range bound, either an ISO 8601 timestamp or a relative form such as "last 24h"
+    Returns the SQL the database resolves the bound with and its parameter, the SQL is None for a naive timestamp
+    Events are stored in the database's time zone, so relative bounds are taken from its clock and timestamps with an
+    offset are converted to its time zone by it rather than by this process
+    """
+    @classmethod
+    def _time_bound(cls, bound):
+        if not isinstance(bound, str):
+            raise Exception("Invalid Time Range",False,400)
+
+        relative = cls.RELATIVE_TIME.fullmatch(bound.strip().lower())
+        if relative is not None:
+            amount,unit = int(relative.group(1)),relative.group(2)
+            try:
+                return "LOCALTIMESTAMP - %s",timedelta(**{cls.TIME_UNITS[unit]:amount})
+            except OverflowError:
+                raise Exception("Invalid Time Range",False,400)
+
+        try:
+            time = datetime.fromisoformat(bound)
+        except ValueError:
+            raise Exception("Invalid Time Range",False,400)
+        if time.tzinfo is not None:
+            return "%s::timestamptz AT TIME ZONE current_setting('TimeZone')",time
+        return None,time
+
+
+    """
+    Replaces the time range bounds of the filters with the naive timestamps they stand for in the database's time zone,
+    read in one query, so the events, the rollups and the archive are all filtered by the same times
+    Bounds which are already timestamps are kept
+    """
+    def _resolve_time_range(self, filters: dict):
+        bounds = {key:self._time_bound(filters[key]) for key in ('from','to') if key in filters and not isinstance(filters[key], datetime)}
+        queried = [key for key,(sql,_) in bounds.items() if sql is not None]
+        filters.update({key:time for key,(sql,time) in bounds.items() if sql is None})
+        if not queried:
+            return
+
+        conn = None
+        try:
+            conn,cur = connect(self._db_config)
+            cur.execute("SELECT "+", ".join(bounds[key][0] for key in queried),tuple(bounds[key][1] for key in queried))
+            filters.update(zip(queried, cur.fetchone()))
+            disconnect(conn,cur)
+
+        #Bounds beyond the range of timestamps, or before year 1 which this process cannot represent
+        except (DataError, ValueError):
+            raise Exception("Invalid Time Range",False,400)
+        except DatabaseError:
+            raise Exception(DATABASE_ERROR,False,500)
+        finally:
+            if conn is not None: release(conn)
+
+
+    """Whether a view's time range is relative to the current time, so its events change as time passes"""
+    @classmethod
+    def _relative_range(cls, filters: dict):
+        return any(isinstance(filters.get(bound), str) and cls.RELATIVE_TIME.fullmatch(filters[bound].strip().lower()) is not None
+        for bound in ('from','to'))
+
+
+    """Whether an attribute filter is an object of operators such as {"gte": 10, "lt": 20} rather than a value to match"""
+    @classmethod
+    def _is_attribute_operators(cls, value):
+        return isinstance(value, dict) and len(value) > 0 and all(key in cls.ATTRIBUTE_OPERATORS for key in value)
+
+
+    """
+    Builds the conditions of an attribute filtered with operators, returning the SQL and its parameters
+    Lists of values are matched by containment so they are served by the GIN index on data, prefixes and numeric ranges
+    are matched by a JSON path. Events are not narrowed to the types declaring the attribute, so like equality filters and
+    the archive they match events whose type has since been detached or lost the attribute
+    """
+    def _attribute_filter(self, attr: str, operators: dict):
+        invalid = Exception("Invalid filter on attribute {0}".format(attr),False,400)
+        query = ""
+        values = []
+
+        if 'in' in operators:
+            if not isinstance(operators['in'], list) or len(operators['in']) > self.MAX_PAGE_SIZE:
+                raise invalid
+            if not operators['in']:
+                return " AND FALSE",[]
+            query += " AND ("+" OR ".join(["data @> %s"]*len(operators['in']))+")"
+            values += [json.dumps({attr:value}) for value in operators['in']]
+
+        #Each remaining operator is a condition on the attribute's value in a JSON path predicate, matched with @@ so the
+        #planner estimates its selectivity from the statistics of data. Operands are validated and written as JSON literals
+        path_conditions = []
+        if 'prefix' in operators:
+            if not isinstance(operators['prefix'], str):
+                raise invalid
+            path_conditions.append('@ starts with {0}'.format(json.dumps(operators['prefix'])))
+        for operator,symbol in self.ATTRIBUTE_COMPARISONS.items():
+            if operator in operators:
+                operand = operators[operator]
+                if not isinstance(operand, (int,float)) or isinstance(operand, bool) or not math.isfinite(operand):
+                    raise invalid
+                path_conditions.append('@ {0} {1}'.format(symbol, json.dumps(operand)))
+
+        if path_conditions:
+            query += " AND data @@ %s::jsonpath"
+            values.append('exists($.{0} ? ({1}))'.format(json.dumps(attr), ' && '.join(path_conditions)))
+        return query,values
+
+
+    #TODO: Have the option to be ordered by an attribute
+
+    """
+    Builds the FROM and WHERE clauses shared by event views and stats, filtered by a specific entity, a time range and a list of attributes
+    Also returns the same filters in the form read by the archive
+    """
+    def _view_filter(self, filters: dict, entity_name: str, join_entities: bool=False):
+        self._resolve_time_range(filters)
+        time_from = filters.pop('from', None)
+        time_to = filters.pop('to', None)
 
         #TODO: Event attributes based on exact database table reference, change to application defined labels
 
         EVENT_ATTRIBUTES = ['events.id','events.type','entity_id','time','success','rb_id'] #Possible filters for events
         event_attr_values = [self._user]
-        query = "SELECT events.id,events.type,entity_id,to_char(time,'DD Mon YYYY HH24:MI:SS'),success,rb_id,data FROM events"
+        query = " FROM events"
         
         #Utilize entity instances table to filter results by a specific entity
-        if entity_name is not None:
+        if entity_name is not None or join_entities:
             query += " INNER JOIN entity_instances ON entity_instances.id = events.entity_id"
         query += " WHERE events.creator = %s"
+        archive_query = {'user':self._user,'entity_name':entity_name,'from':None,'to':None,'cursor':None,'columns':{},'data':{},'operators':{}}
         
         
-        #TODO: Create more versatile date filtering rather than exact match eg. date range
         #TODO: Currently filtering mainly by IDs, should utilize names instead
 
+        #Time range from inclusive to exclusive, served by the (creator, time) and (creator, type, time) indexes
+        if time_from is not None:
+            query += " AND time >= %s"
+            event_attr_values.append(time_from)
+            archive_query['from'] = time_from
+        if time_to is not None:
+            query += " AND time < %s"
+            event_attr_values.append(time_to)
+            archive_query['to'] = time_to
+
         #Build WHERE clause for filtering of selected event attributes
-        if filters is not None:
-            for attr in EVENT_ATTRIBUTES:
-                if attr in filters:
-                    filter = filters.get(attr)
-                    query += " AND "+attr+" = %s "
-                    event_attr_values += [filter]
-                    del filters[attr]
-        
-            #Fiiltering by invariate event type specific attributes
-            for attr in filters:
-                query += " AND data @> %s"
-                event_attr_values += [json.dumps({attr:filters[attr]})]
+        for attr in EVENT_ATTRIBUTES:
+            if attr in filters:
+                filter = filters.get(attr)
+                query += " AND "+attr+" = %s "
+                event_attr_values += [filter]
+                archive_query['columns'][attr.split('.')[-1]] = filter
+                del filters[attr]
+    
+        #Fiiltering by invariate event type specific attributes
+        for attr in filters:
+            if self._is_attribute_operators(filters[attr]):
+                condition,values = self._attribute_filter(attr, filters[attr])
+                query += condition
+                event_attr_values += values
+                archive_query['operators'][attr] = filters[attr]
+                continue
+
+            query += " AND data @> %s"
+            event_attr_values += [json.dumps({attr:filters[attr]})]
+            archive_query['data'][attr] = filters[attr]
 
         #Utilize entity instances table to select a specific entity
         if entity_name is not None:
             query += " AND entity_instances.name = %s"
             event_attr_values.append(entity_name)
 
-        query += "ORDER BY time DESC"
+        return query,event_attr_values,archive_query
+
+
+    """
+    Builds the query selecting events newest first, filtered by a specific entity, a list of attributes and a cursor
+    One event more than the limit is selected to know whether there is a next page
+    Also returns the same filters in the form read by the archive
+    """
+    def _view_query(self, filters: dict, entity_name: str, limit):
+        cursor = filters.pop('cursor', None)
+        condition,event_attr_values,archive_query = self._view_filter(filters, entity_name)
+        query = "SELECT events.id,events.type,entity_id,to_char(time,'DD Mon YYYY HH24:MI:SS'),success,rb_id,data,time"+condition
+
+        #Keyset pagination continues after the last event of the previous page, an index range scan on (creator, time, id)
+        #The separate bound on time lets partitions newer than the cursor be pruned
+        if cursor is not None:
+            cursor_time,cursor_id = self._decode_cursor(cursor)
+            query += " AND time <= %s AND (time, events.id) < (%s, %s)"
+            event_attr_values.extend([cursor_time,cursor_time,cursor_id])
+            archive_query['cursor'] = (cursor_time,cursor_id)
+
+        query += " ORDER BY time DESC, events.id DESC"
+        if limit is not None:
+            query += " LIMIT %s"
+            event_attr_values.append(limit+1)
+        return query,tuple(event_attr_values),archive_query
+
+
+    """
+    View a page of the events' details, newest first, can be filtered by a specific entity or by a list of attributes
+    The next page is requested by sending the returned next_cursor, which is null on the last page
+    Pages are served from the query cache when it is enabled and holds a current result, or one at most max_age seconds old
+    """
+    def view(self, filters, entity_name : str=None, max_age: float=None):
+        events = []
+        count = 0
+
+        filters = dict(filters or {})
+        limit = self._view_limit(filters, self.DEFAULT_PAGE_SIZE)
+
+        query_cache = get_query_cache()
+        if query_cache is not None:
+            key = query_cache.key(self._user, entity_name, limit, filters)
+            result = query_cache.get(key, self._user, not self._relative_range(filters), max_age)
+            if result is not None:
+                return result,True,200
+            version = query_cache.version(self._user)
+
+        query,values,archive_query = self._view_query(filters, entity_name, limit)
 
         conn = None
         try:
             conn,cur = connect(self._db_config)
-            cur.execute(query,tuple(event_attr_values))
-            count=cur.rowcount
+            cur.execute(query,values)
             events = cur.fetchall() 
             disconnect(conn,cur)
 
         except DatabaseError:
             raise Exception(DATABASE_ERROR,False,500)
         finally:
-            if conn is not None: conn.close()
+            if conn is not None: release(conn)
+
+        #Archived events matching the filters are merged in, both are ordered newest first
+        archive = get_archive()
+        if archive is not None:
+            archived = itertools.islice(archive.events(archive_query), limit+1)
+            events = list(itertools.islice(heapq.merge(events, archived, key=self._row_order, reverse=True), limit+1))
+
+        next_cursor = None
+        if len(events) > limit:
+            events = events[:limit]
+            next_cursor = self._encode_cursor(events[-1][7], events[-1][0])
+        count = len(events)
+
+        result = {'events_returned':count,'events':label_rows(self.EVENT_LABELS,events),'next_cursor':next_cursor}
+        if query_cache is not None:
+            query_cache.set(key, version, result)
+        return result,True,200
+
 
-        labels = ['event.id','event.type','entity_id','time','success','rb_id','attributes']
-        return {'events_returned':count,'events':label_rows(labels,events)},True,200
+    """
+    Streams the events' details read through a server side cursor, taking the same filters as view
+    Every matching event is streamed unless a limit is sent, the first rows are fetched here so query errors are reported before streaming starts
+    """
+    def stream(self, filters, entity_name : str=None, format : str='json'):
+        if format not in EventStream.CONTENT_TYPES:
+            raise Exception("Stream must be one of {0}".format(', '.join(EventStream.CONTENT_TYPES)),False,400)
+
+        filters = dict(filters or {})
+        limit = self._view_limit(filters, None)
+        query,values,archive_query = self._view_query(filters, entity_name, limit)
+
+        conn = None
+        try:
+            conn,cur = connect(self._db_config, cursor_name='event_stream')
+            cur.execute(query,values)
+            first_rows = cur.fetchmany(EventStream.FETCH_SIZE)
+
+        except DatabaseError:
+            if conn is not None: release(conn)
+            raise Exception(DATABASE_ERROR,False,500)
+
+        archive = get_archive()
+        archived = archive.events(archive_query) if archive is not None else None
+        return EventStream(conn, cur, first_rows, limit, format, archived),True,200
         
 
-    """View each entity instance's details"""
-    def view_entity_instances(self):
+    """
+    Counts the events matching the same filters as view, grouped by any of event type, entity type, entity and success
+    and split into time buckets. The database counts the events so only one row per group is read, from the rollups of
+    events when the groups and filters allow
+    """
+    def stats(self, filters):
+        filters = dict(filters or {})
+        group_by = filters.pop('group_by', [])
+        bucket = filters.pop('bucket', None)
+
+        if not isinstance(group_by, list) or not all(isinstance(key, str) and key in self.STAT_GROUPS for key in group_by) \
+        or len(set(group_by)) != len(group_by):
+            raise Exception("group_by must be a list of {0}".format(', '.join(self.STAT_GROUPS)),False,400)
+        if bucket is not None and bucket not in self.STAT_BUCKETS:
+            raise Exception("bucket must be one of {0}".format(', '.join(self.STAT_BUCKETS)),False,400)
+        for param in ('limit','cursor','stream'):
+            if param in filters:
+                raise Exception("{0} does not apply to event stats".format(param),False,400)
+
+        self._resolve_time_range(filters)
+        counts = self._rollup_counts(filters, group_by, bucket)
+        if counts is None:
+            counts = self._event_counts(filters, group_by, bucket)
+        if len(counts) > self.MAX_STAT_GROUPS:
+            raise Exception("More than {0} groups, use a coarser bucket or narrower filters".format(self.MAX_STAT_GROUPS),False,400)
+
+        conn = None
+        try:
+            conn,cur = connect(self._db_config)
+            groups = self._label_stats(cur, counts, group_by, bucket)
+            disconnect(conn,cur)
+
+        except DatabaseError:
+            raise Exception(DATABASE_ERROR,False,500)
+        finally:
+            if conn is not None: release(conn)
+
+        return {'groups_returned':len(groups),'events_counted':sum(counts.values()),'groups':groups},True,200
+
+
+    """Counts the matching events themselves, in the database and in the archive, keyed by their group and time bucket"""
+    def _event_counts(self, filters, group_by, bucket):
+        condition,values,archive_query = self._view_filter(dict(filters), None, join_entities='entity_type' in group_by)
+        columns = [self.STAT_GROUPS[key] for key in group_by]
+        if bucket is not None:
+            columns.append("date_trunc(%s, time)")
+            values.insert(0, bucket)
+
+        query = "SELECT "+", ".join(columns+["count(*)"])+condition
+        if columns:
+            query += " GROUP BY "+", ".join(str(position) for position in range(1, len(columns)+1))
+        query += " LIMIT %s"
+        values.append(self.MAX_STAT_GROUPS+1)
+
+        conn = None
+        try:
+            conn,cur = connect(self._db_config)
+            cur.execute(query,tuple(values))
+            counts = collections.Counter({row[:-1]:row[-1] for row in cur.fetchall()})
+            disconnect(conn,cur)
+
+        except DatabaseError:
+            raise Exception(DATABASE_ERROR,False,500)
+        finally:
+            if conn is not None: release(conn)
+
+        archive = get_archive()
+        archived = collections.Counter()
+        if archive is not None:
+            for row in archive.events(archive_query):
+                archived[(row[1],row[2],row[4],self._truncate(row[7], bucket))] += 1
+        if not archived:
+            return counts
+
+        conn = None
+        try:
+            conn,cur = connect(self._db_config)
+            counts.update(self._archived_stats(cur, archived, group_by, bucket))
+            disconnect(conn,cur)
+
+        except DatabaseError:
+            raise Exception(DATABASE_ERROR,False,500)
+        finally:
+            if conn is not None: release(conn)
+        return counts
+
+
+    """
+    Counts the matching events from the hourly or daily rollups, which include archived events, returning None when the
+    filters or groups are finer than the rollups. A time range which starts or ends part way through a bucket has the
+    events of that part counted from the events themselves
+    """
+    def _rollup_counts(self, filters, group_by, bucket):
+        if not set(group_by) <= set(self.ROLLUP_GROUPS) or bucket == 'minute':
+            return None
+        if not all(key in ('from','to') or key in self.ROLLUP_FILTERS for key in filters):
+            return None
+
+        time_from = filters.get('from')
+        time_to = filters.get('to')
+        granularity = bucket or ('hour' if time_from is not None or time_to is not None else 'day')
+        step = timedelta(**{granularity+'s':1})
+
+        #The rollups cover the whole buckets within the time range
+        rollup_from = rollup_to = None
+        if time_from is not None:
+            rollup_from = self._truncate(time_from, granularity)
+            if rollup_from < time_from:
+                rollup_from += step
+        if time_to is not None:
+            rollup_to = self._truncate(time_to, granularity)
+        if rollup_from is not None and rollup_to is not None and rollup_from >= rollup_to:
+            return None
+
+        #Deltas not yet compacted are hourly and counted alongside the rollups
+        delta_bucket = "bucket" if granularity == 'hour' else "date_trunc('day', bucket)"
+        columns = list(group_by)+(["bucket"] if bucket is not None else [])
+        query = "SELECT "+", ".join(columns+["sum(events)::BIGINT"])+""" FROM (
+        SELECT creator, bucket, event_type, entity_type, success, events FROM event_rollups_"""+granularity+"""
+        UNION ALL SELECT creator, """+delta_bucket+""", event_type, entity_type, success, events FROM event_rollup_deltas
+        ) AS rollups WHERE creator = %s"""
+        values = [self._user]
+
+        if rollup_from is not None:
+            query += " AND bucket >= %s"
+            values.append(rollup_from)
+        if rollup_to is not None:
+            query += " AND bucket < %s"
+            values.append(rollup_to)
+        for attr,column in self.ROLLUP_FILTERS.items():
+            if attr in filters:
+                query += " AND "+column+" = %s"
+                values.append(filters[attr])
+        if columns:
+            query += " GROUP BY "+", ".join(str(position) for position in range(1, len(columns)+1))
+        query += " LIMIT %s"
+        values.append(self.MAX_STAT_GROUPS+1)
+
+        conn = None
+        try:
+            conn,cur = connect(self._db_config)
+            cur.execute(query,tuple(values))
+            counts = collections.Counter({row[:-1]:row[-1] or 0 for row in cur.fetchall()})
+            disconnect(conn,cur)
+
+        except DatabaseError:
+            raise Exception(DATABASE_ERROR,False,500)
+        finally:
+            if conn is not None: release(conn)
+
+        #Parts of buckets at either end of the time range
+        for edge_from,edge_to in ((time_from,rollup_from),(rollup_to,time_to)):
+            if edge_from is not None and edge_to is not None and edge_from < edge_to:
+                edge = dict(filters, **{'from':edge_from,'to':edge_to})
+                counts.update(self._event_counts(edge, group_by, bucket))
+        return counts
+
+
+    """Start of the time bucket an event falls in"""
+    @staticmethod
+    def _truncate(time, bucket):
+        if bucket is None:
+            return None
+        units = ('day','hour','minute','second','microsecond')
+        return time.replace(**{unit:0 for unit in units[units.index(bucket)+1:]})
+
+
+    """Counts of archived events keyed by the same group as the database's counts, archived events hold the id of their entity but not its type"""
+    def _archived_stats(self, cur, archived, group_by, bucket):
+        entity_types = {}
+        if archived and 'entity_type' in group_by:
+            cur.execute("SELECT id, type FROM entity_instances WHERE creator = %s AND id = ANY(%s)",
+            (self._user, sorted({entity_id for _,entity_id,_,_ in archived})))
+            entity_types = dict(cur.fetchall())
+
+        counts = collections.Counter()
+        for (event_type,entity_id,success,time),count in archived.items():
+            details = {'event_type':event_type,'entity_type':entity_types.get(entity_id),'entity':entity_id,'success':success}
+            counts[tuple(details[key] for key in group_by)+((time,) if bucket is not None else ())] += count
+        return counts
+
+
+    """Labels each group with the names of its event type, entity type and entity, ordered by time bucket and then by count"""
+    def _label_stats(self, cur, counts, group_by, bucket):
+        NAME_TABLES = {'event_type':'event_types','entity_type':'entity_types','entity':'entity_instances'}
+        names = {}
+        for position,key in enumerate(group_by):
+            if key in NAME_TABLES:
+                ids = sorted({group[position] for group in counts if group[position] is not None})
+                cur.execute("SELECT id, name FROM "+NAME_TABLES[key]+" WHERE creator = %s AND id = ANY(%s)",(self._user,ids))
+                names[key] = dict(cur.fetchall())
+
+        groups = []
+        for group,count in counts.items():
+            labelled = {key:names[key].get(value) if key in names else value for key,value in zip(group_by, group)}
+            if bucket is not None:
+                labelled['time'] = group[-1].isoformat()
+            labelled['count'] = count
+            groups.append(labelled)
+
+        groups.sort(key=lambda labelled: (labelled.get('time', ''), -labelled['count'], [str(labelled[key]) for key in group_by]))
+        return groups
+
+
+    """
+    View each entity instance's details with its latest event, read from entity_latest_events rather than from the events
+    An instance was last modified by its latest event
+    Can be filtered by the instances' type and name and by the type, success and time of their latest event
+    """
+    def view_entity_instances(self, filters=None):
         instances = []
         count = 0
 
+        filters = dict(filters or {})
+        self._resolve_time_range(filters)
+        time_from = filters.pop('from', None)
+        time_to = filters.pop('to', None)
+
+        #Latest events not yet compacted are taken into account so the view is always current
+        query = """WITH latest_events AS (
+            SELECT DISTINCT ON (entity_id) entity_id, event_id, event_type, time, success FROM (
+                SELECT entity_latest_events.* FROM entity_latest_events
+                INNER JOIN entity_instances ON entity_instances.id = entity_latest_events.entity_id WHERE creator = %s
+                UNION ALL
+                SELECT entity_id, event_id, event_type, time, success FROM entity_latest_deltas WHERE creator = %s
+            ) AS candidates
+            ORDER BY entity_id, time DESC, event_id DESC
+        )
+        SELECT entity_instances.id, name, type, to_char(created, 'DD Mon YYYY HH24:MI:SS'),to_char(COALESCE(time, created), 'DD Mon YYYY HH24:MI:SS'),
+        event_id, event_type, to_char(time, 'DD Mon YYYY HH24:MI:SS'), success
+        FROM entity_instances
+        LEFT JOIN latest_events ON latest_events.entity_id = entity_instances.id
+        WHERE creator = %s"""
+        values = [self._user,self._user,self._user]
+
+        #Time range of the latest event from inclusive to exclusive
+        if time_from is not None:
+            query += " AND time >= %s"
+            values.append(time_from)
+        if time_to is not None:
+            query += " AND time < %s"
+            values.append(time_to)
+
+        for attr,value in filters.items():
+            if attr not in self.ENTITY_FILTERS:
+                raise Exception("Unknown Entity Filter {0}".format(attr),False,400)
+            query += " AND "+self.ENTITY_FILTERS[attr]+" = %s"
+            values.append(value)
+        query += " ORDER BY entity_instances.id"
+
         conn = None
         try:
             conn,cur = connect(self._db_config)
-            cur.execute("""SELECT id, name, type, to_char(created, 'DD Mon YYYY HH24:MI:SS'),to_char(modified, 'DD Mon YYYY HH24:MI:SS') 
-            FROM entity_instances 
-            WHERE creator = %s""",(self._user,))
+            cur.execute(query,tuple(values))
 
             count=cur.rowcount
             instances = cur.fetchall()
@@ -151,8 +901,84 @@ class Event():
         except DatabaseError:
             raise Exception(DATABASE_ERROR,False,500)
         finally:
-            if conn is not None: conn.close()
+            if conn is not None: release(conn)
+
+        return {'entities_returned':count,'entities':label_rows(self.ENTITY_LABELS,instances)},True,200
+        
+
+"""
+Events read through a server side cursor and encoded a batch at a time, so memory use does not grow with the number of events
+Encoded either as the JSON response of a view, written incrementally, or as newline delimited JSON with one event per line
+Archived events, when given, are merged in as they are also ordered newest first. The connection is held until the stream is closed
+"""
+class EventStream():
+    CONTENT_TYPES = {'json':'application/json;charset=utf-8','ndjson':'application/x-ndjson;charset=utf-8'}
+
+    #Rows fetched from the server side cursor at a time, each batch is written as one chunk
+    FETCH_SIZE = 500
+
+    def __init__(self, conn, cur, first_rows: list, limit, format: str, archived=None):
+        self._conn = conn
+        self._cur = cur
+        self._first_rows = first_rows
+        self._limit = limit
+        self._format = format
+        self._archived = archived
 
-        labels = ['id','name','type','created','modified']
-        return {'entities_returned':count,'entities':label_rows(labels,instances)},True,200
-        
\ No newline at end of file
+    @property
+    def content_type(self):
+        return self.CONTENT_TYPES[self._format]
+
+    def _rows(self):
+        rows = self._first_rows
+        while rows:
+            yield from rows
+            rows = self._cur.fetchmany(self.FETCH_SIZE)
+
+    """Yields the encoded events in chunks of bytes"""
+    def chunks(self):
+        count = 0
+        last = None
+        next_cursor = None
+
+        rows = self._rows()
+        if self._archived is not None:
+            rows = heapq.merge(rows, self._archived, key=Event._row_order, reverse=True)
+        #The row beyond the limit only signals there is a next page
+        if self._limit is not None:
+            rows = itertools.islice(rows, self._limit+1)
+
+        if self._format == 'json':
+            yield b'{"result": {"events": ['
+
+        while True:
+            batch = list(itertools.islice(rows, self.FETCH_SIZE))
+            if self._limit is not None and count+len(batch) > self._limit:
+                batch = batch[:self._limit-count]
+                next_cursor = Event._encode_cursor(*(last if not batch else Event._row_order(batch[-1])))
+            if not batch:
+                break
+
+            events = label_rows(Event.EVENT_LABELS,batch)
+            if self._format == 'json':
+                yield ((', ' if count else '')+', '.join(json.dumps(event) for event in events)).encode()
+            else:
+                yield ''.join(json.dumps(event)+'\n' for event in events).encode()
+
+            count += len(batch)
+            last = Event._row_order(batch[-1])
+            if next_cursor is not None:
+                break
+
+        if self._format == 'json':
+            yield '], "events_returned": {0}, "next_cursor": {1}}}, "success": true, "code": 200}}'.format(count,json.dumps(next_cursor)).encode()
+
+    """Closes the server side cursor and returns the connection to its pool"""
+    def close(self):
+        try:
+            self._cur.close()
+        except Error:
+            #The cursor of a connection which was closed or broke mid stream can no longer be closed
+            pass
+        finally:
+            release(self._conn)
@@ -0,0 +1,154 @@
+"""
+Group commit of synchronous event inserts
+Events added concurrently are inserted in one shared transaction so the database flushes its log once per group rather than once per event
+"""
+
+import time
+import threading
+from psycopg2 import DatabaseError, OperationalError
+from psycopg2.extras import execute_values
+from utils import connect,disconnect,release
+
+
+"""An event waiting in a group, the submitting thread blocks until its outcome is known"""
+class _Submission:
+    def __init__(self, params: tuple):
+        self.params = params
+        self.event_id = None
+        self.error = None
+        self.done = threading.Event()
+
+
+"""
+Gathers the ingest_event calls submitted by request threads and commits them together
+once the group is full or the window since its first event has passed
+All the events of a group are inserted in one statement, if that fails each event is retried under its
+own savepoint so a failing event only fails its own request
+"""
+class GroupCommitter:
+    def __init__(self, db_config: dict, max_size: int=64, window: float=0.002):
+        self._db_config = db_config
+        self._max_size = max_size
+        self._window = window
+
+        self._lock = threading.Condition()
+        self._queue = []
+        self._closed = False
+
+        self._committer = threading.Thread(target=self._commit_loop, name='group-committer', daemon=True)
+        self._committer.start()
+
+
+    """
+    Inserts an event through ingest_event as part of the next group and waits until the group is committed
+    Returns the new event's id or None when the names are invalid, raises DatabaseError when the event was not stored
+    """
+    def submit(self, params: tuple):
+        submission = _Submission(params)
+        with self._lock:
+            if self._closed:
+                raise OperationalError("Group commit is closed")
+            self._queue.append(submission)
+            self._lock.notify_all()
+
+        submission.done.wait()
+        if submission.error is not None:
+            raise submission.error
+        return submission.event_id
+
+
+    """Commits the events already submitted and stops the committer"""
+    def close(self, timeout: float=10.0):
+        with self._lock:
+            self._closed = True
+            self._lock.notify_all()
+        self._committer.join(timeout)
+
+
+    """Waits for a first event then gathers events until the group is full, the window has passed or the committer is closed"""
+    def _next_group(self):
+        with self._lock:
+            while not self._queue and not self._closed:
+                self._lock.wait()
+
+            deadline = time.monotonic() + self._window
+            while len(self._queue) < self._max_size and not self._closed:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._lock.wait(remaining)
+
+            group = self._queue[:self._max_size]
+            del self._queue[:self._max_size]
+            return group
+
+
+    def _commit_loop(self):
+        while True:
+            group = self._next_group()
+            if not group:
+                return
+
+            try:
+                self._commit(group)
+            except Exception as error:
+                for submission in group:
+                    if submission.error is None: submission.error = error if isinstance(error, DatabaseError) else DatabaseError(str(error))
+            finally:
+                for submission in group:
+                    submission.done.set()
+
+
+    def _commit(self, group):
+        conn = None
+        try:
+            conn,cur = connect(self._db_config)
+            try:
+                rows = execute_values(cur,
+                """SELECT e.position, ingest_event(e.entity_type,e.event_type,e.entity_name,e.creator,e.success,e.rb_id,e.notes,e.data)
+                FROM (VALUES %s) AS e(position,entity_type,event_type,entity_name,creator,success,rb_id,notes,data)""",
+                [(position,)+submission.params for position,submission in enumerate(group)],
+                template='(%s,%s::TEXT,%s::TEXT,%s::TEXT,%s::INT,%s::BOOLEAN,%s::INT,%s::TEXT,%s::JSONB)',
+                page_size=len(group), fetch=True)
+                for position,event_id in rows:
+                    group[position].event_id = event_id
+
+            except OperationalError:
+                raise
+            except DatabaseError:
+                conn.rollback()
+                self._commit_each(cur, group)
+
+            conn.commit()
+            disconnect(conn,cur)
+        finally:
+            if conn is not None: release(conn)
+
+
+    """Inserts each event of a group under its own savepoint, recording the error of any event which fails"""
+    def _commit_each(self, cur, group):
+        for index,submission in enumerate(group):
+            #Releasing the previous savepoint in the same round trip keeps the number of open subtransactions at one
+            statement = "SAVEPOINT group_event; SELECT ingest_event(%s,%s,%s,%s,%s,%s,%s,%s)"
+            if index > 0:
+                statement = "RELEASE SAVEPOINT group_event; "+statement
+            try:
+                cur.execute(statement, submission.params)
+                submission.event_id = cur.fetchone()[0]
+            except OperationalError:
+                raise
+            except DatabaseError as error:
+                submission.error = error
+                cur.execute("ROLLBACK TO SAVEPOINT group_event")
+
+
+#Coordinator used by Event.add, None unless the server was started with group commit enabled
+_group_committer = None
+
+def configure_group_commit(db_config: dict, **settings) -> GroupCommitter:
+    global _group_committer
+    _group_committer = GroupCommitter(db_config, **settings)
+    return _group_committer
+
+def get_group_committer():
+    return _group_committer
@@ -0,0 +1,376 @@
+"""
+Local append only journal of accepted events which are written to the event store in the background
+Events are durable once their journal record is fsynced, so producers are answered before the database is involved
+"""
+
+import os
+import json
+import time
+import uuid
+import threading
+from collections import deque
+from psycopg2 import DatabaseError, OperationalError
+from events import Event
+from querycache import get_query_cache
+from utils import connect,disconnect,release
+
+
+"""
+Journal of events stored as segment files of JSON lines in a directory
+Every record has a sequence number, the highest sequence written to the event store is stored in the journal_offsets table
+in the same transaction as the events, so records are written exactly once even when the server restarts mid batch
+"""
+class Journal:
+    SEGMENT_PREFIX = 'segment-'
+    SEGMENT_SUFFIX = '.log'
+
+    def __init__(self, directory: str, db_config: dict, segment_size: int=16*1024*1024, fsync_interval: float=0.005,
+                batch_size: int=1000, batch_interval: float=0.05, max_pending: int=100000):
+        self._directory = directory
+        self._db_config = db_config
+        self._segment_size = segment_size
+        self._fsync_interval = fsync_interval
+        self._batch_size = batch_size
+        self._batch_interval = batch_interval
+        self._max_pending = max_pending
+
+        os.makedirs(directory, exist_ok=True)
+        self._journal_id = self._read_journal_id()
+
+        self._lock = threading.Condition()
+        self._pending = deque()   #(seq, time appended, user, event) not yet written to the event store
+        self._next_seq = 1
+        self._written_seq = 0     #Highest sequence in the current segment file
+        self._flushed_seq = 0     #Highest sequence fsynced to disk
+        self._acked_seq = None    #Highest sequence written to the event store, unknown until read from the database
+        self._segments = []       #(first sequence, path) in order, the last is being appended to
+        self._file = None
+        self._closed = False
+        self._stopped = False     #Set once close has made its final fsync, or failed to
+
+        #Counters reported by metrics
+        self._appended = 0
+        self._stored = 0
+        self._rejected = 0
+
+        self._replay()
+
+        self._flusher = threading.Thread(target=self._flush_loop, name='journal-flusher', daemon=True)
+        self._writer = threading.Thread(target=self._write_loop, name='journal-writer', daemon=True)
+        self._flusher.start()
+        self._writer.start()
+
+    @property
+    def journal_id(self):
+        return self._journal_id
+
+
+    """
+    Appends an event to the journal and waits until it is durable, returns False when too many events are waiting to be written
+    or the journal is closed. A record written before the journal closed is made durable by the final fsync of close and
+    reported as appended, as it is replayed on restart
+    """
+    def append(self, user, event: dict) -> bool:
+        with self._lock:
+            if self._closed or len(self._pending) >= self._max_pending:
+                return False
+
+            seq = self._next_seq
+            self._next_seq += 1
+            appended = time.time()
+            line = json.dumps({'seq':seq,'time':appended,'user':user,'event':event}, separators=(',',':')).encode()+b'\n'
+
+            if self._file.tell() >= self._segment_size:
+                self._rotate(seq)
+            self._file.write(line)
+            self._written_seq = seq
+            self._pending.append((seq,appended,user,event))
+            self._appended += 1
+            self._lock.notify_all()
+
+            while self._flushed_seq < seq and not self._stopped:
+                self._lock.wait()
+        return self._flushed_seq >= seq
+
+
+    """Journal state reported by the metrics endpoint"""
+    def metrics(self) -> dict:
+        with self._lock:
+            oldest = self._pending[0][1] if self._pending else None
+            return {
+                'journal_id':self._journal_id,
+                'queue_depth':len(self._pending),
+                'lag_seconds':round(time.time()-oldest, 3) if oldest is not None else 0,
+                'segments':len(self._segments),
+                'appended':self._appended,
+                'stored':self._stored,
+                'rejected':self._rejected,
+                'acked_seq':self._acked_seq
+            }
+
+
+    """Stops accepting events and gives the writer until the timeout to store the events waiting, the rest are replayed on restart"""
+    def close(self, timeout: float=10.0):
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            while self._pending and self._acked_seq is not None and time.monotonic() < deadline:
+                self._lock.wait(0.1)
+            self._closed = True
+            self._lock.notify_all()
+
+        self._writer.join(max(0, deadline-time.monotonic()))
+        self._flusher.join(1)
+        with self._lock:
+            try:
+                self._sync()
+                self._file.close()
+            finally:
+                self._stopped = True
+                self._lock.notify_all()
+
+
+    def _read_journal_id(self):
+        path = os.path.join(self._directory, 'journal.id')
+        if not os.path.exists(path):
+            with open(path+'.tmp', 'w') as file:
+                file.write(uuid.uuid4().hex)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(path+'.tmp', path)
+        with open(path) as file:
+            return file.read().strip()
+
+
+    """Loads every record left in the segments into the pending queue and reopens the last segment for appending"""
+    def _replay(self):
+        names = sorted(name for name in os.listdir(self._directory) if name.startswith(self.SEGMENT_PREFIX) and name.endswith(self.SEGMENT_SUFFIX))
+        for name in names:
+            path = os.path.join(self._directory, name)
+            self._segments.append((int(name[len(self.SEGMENT_PREFIX):-len(self.SEGMENT_SUFFIX)]), path))
+
+            valid_length = 0
+            with open(path, 'rb') as file:
+                for line in file:
+                    #A record cut short by a crash was never acknowledged to the producer and is dropped
+                    if not line.endswith(b'\n'):
+                        break
+                    record = json.loads(line)
+                    self._pending.append((record['seq'],record['time'],record['user'],record['event']))
+                    self._next_seq = record['seq']+1
+                    valid_length += len(line)
+
+            if os.path.getsize(path) != valid_length:
+                os.truncate(path, valid_length)
+
+        if self._segments:
+            self._next_seq = max(self._next_seq, self._segments[-1][0])
+            self._file = open(self._segments[-1][1], 'ab')
+        else:
+            self._rotate(self._next_seq)
+        self._written_seq = self._flushed_seq = self._next_seq-1
+
+
+    """Starts a new segment whose name is the first sequence it will hold, lock must be held"""
+    def _rotate(self, first_seq):
+        if self._file is not None:
+            self._sync()
+            self._file.close()
+
+        path = os.path.join(self._directory, '{0}{1:020d}{2}'.format(self.SEGMENT_PREFIX, first_seq, self.SEGMENT_SUFFIX))
+        self._file = open(path, 'ab')
+        self._segments.append((first_seq, path))
+
+        #The new file's directory entry must be durable as well as its contents
+        directory = os.open(self._directory, os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+
+    """Flushes and fsyncs the current segment, lock must be held"""
+    def _sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._flushed_seq = max(self._flushed_seq, self._written_seq)
+        self._lock.notify_all()
+
+
+    """Fsyncs appended records in groups, waiting briefly after the first unsynced record so concurrent appends share one fsync"""
+    def _flush_loop(self):
+        while True:
+            with self._lock:
+                while self._flushed_seq >= self._written_seq and not self._closed:
+                    self._lock.wait()
+                if self._closed:
+                    return
+            time.sleep(self._fsync_interval)
+
+            #The fsync runs on a duplicate descriptor outside the lock so appends continue, and a rotation may close the segment meanwhile
+            with self._lock:
+                if self._file.closed:
+                    continue
+                self._file.flush()
+                seq = self._written_seq
+                fd = os.dup(self._file.fileno())
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+            with self._lock:
+                self._flushed_seq = max(self._flushed_seq, seq)
+                self._lock.notify_all()
+
+
+    """Writes pending records to the event store in batches, retrying while the database is unavailable"""
+    def _write_loop(self):
+        delay = 0.1
+        while True:
+            with self._lock:
+                if self._closed:
+                    return
+
+            try:
+                if self._acked_seq is None:
+                    self._load_acked_seq()
+
+                batch = self._next_batch()
+                if batch:
+                    self._store(batch)
+                delay = 0.1
+
+            except OperationalError as error:
+                print("Journal writer waiting for the database: {0}".format(error))
+                time.sleep(delay)
+                delay = min(delay*2, 5.0)
+            except Exception as error:
+                print("Journal writer error: {0}".format(error))
+                time.sleep(delay)
+                delay = min(delay*2, 5.0)
+
+
+    """Reads the highest stored sequence and drops replayed records which were already stored"""
+    def _load_acked_seq(self):
+        conn = None
+        try:
+            conn,cur = connect(self._db_config)
+            cur.execute("SELECT seq FROM journal_offsets WHERE journal_id = %s",(self._journal_id,))
+            row = cur.fetchone()
+            disconnect(conn,cur)
+        finally:
+            if conn is not None: release(conn)
+
+        with self._lock:
+            self._acked_seq = row[0] if row is not None else 0
+            while self._pending and self._pending[0][0] <= self._acked_seq:
+                self._pending.popleft()
+        self._remove_stored_segments()
+
+
+    """Waits for durable pending records and returns up to a batch of them, without removing them from the queue"""
+    def _next_batch(self):
+        deadline = time.monotonic() + self._batch_interval
+        with self._lock:
+            while not self._closed:
+                durable = 0
+                while durable < min(self._batch_size, len(self._pending)) and self._pending[durable][0] <= self._flushed_seq:
+                    durable += 1
+                remaining = deadline - time.monotonic()
+                if durable >= self._batch_size or (durable > 0 and remaining <= 0):
+                    return [self._pending[index] for index in range(durable)]
+                self._lock.wait(remaining if durable > 0 else self._batch_interval)
+        return []
+
+
+    """Inserts a batch grouped by user and records the highest stored sequence in one transaction"""
+    def _store(self, batch):
+        by_user = {}
+        for seq,_,user,event in batch:
+            by_user.setdefault(user, []).append((seq,event))
+
+        rejected = []
+        conn = None
+        try:
+            conn,cur = connect(self._db_config)
+            for user,records in by_user.items():
+                report = Event(self._db_config, user)._insert_batch(cur, [event for _,event in records])
+                rejected.extend((seq,user,event,item['result']) for (seq,event),item in zip(records,report) if not item['success'])
+
+            cur.execute("""INSERT INTO journal_offsets(journal_id,seq) VALUES(%s,%s)
+            ON CONFLICT (journal_id) DO UPDATE SET seq = EXCLUDED.seq""",(self._journal_id,batch[-1][0]))
+            conn.commit()
+            disconnect(conn,cur)
+
+        except OperationalError:
+            raise
+        except DatabaseError as error:
+            #A batch the database refuses for reasons other than availability is stored one record at a time
+            if conn is not None: release(conn)
+            conn = None
+            if len(batch) > 1:
+                for record in batch:
+                    self._store([record])
+                return
+            rejected.append((batch[0][0],batch[0][2],batch[0][3],str(error).strip()))
+            self._store_offset_only(batch[0][0])
+        finally:
+            if conn is not None: release(conn)
+
+        for seq,user,event,reason in rejected:
+            self._reject(seq, user, event, reason)
+
+        query_cache = get_query_cache()
+        if query_cache is not None:
+            for user in by_user:
+                query_cache.bump(user)
+
+        with self._lock:
+            for _ in batch:
+                self._pending.popleft()
+            self._acked_seq = batch[-1][0]
+            self._stored += len(batch)-len(rejected)
+            self._lock.notify_all()
+        self._remove_stored_segments()
+
+
+    """Records a sequence as stored when its record was rejected on its own"""
+    def _store_offset_only(self, seq):
+        conn = None
+        try:
+            conn,cur = connect(self._db_config)
+            cur.execute("""INSERT INTO journal_offsets(journal_id,seq) VALUES(%s,%s)
+            ON CONFLICT (journal_id) DO UPDATE SET seq = EXCLUDED.seq""",(self._journal_id,seq))
+            conn.commit()
+            disconnect(conn,cur)
+        finally:
+            if conn is not None: release(conn)
+
+
+    """Keeps events the event store refused in a separate file for inspection"""
+    def _reject(self, seq, user, event, reason):
+        print("Journal record {0} of user {1} rejected: {2}".format(seq, user, reason))
+        with self._lock:
+            self._rejected += 1
+            with open(os.path.join(self._directory, 'rejected.log'), 'a') as file:
+                file.write(json.dumps({'seq':seq,'user':user,'event':event,'reason':reason})+'\n')
+
+
+    """Deletes segments whose every record has been stored, the segment being appended to is kept"""
+    def _remove_stored_segments(self):
+        with self._lock:
+            while len(self._segments) > 1 and self._segments[1][0]-1 <= self._acked_seq:
+                _,path = self._segments.pop(0)
+                os.remove(path)
+
+
+#Journal used by POST v1/events for asynchronous ingestion, None unless the server was started with a journal directory
+_journal = None
+
+def configure_journal(directory: str, db_config: dict, **settings) -> Journal:
+    global _journal
+    _journal = Journal(directory, db_config, **settings)
+    return _journal
+
+def get_journal():
+    return _journal
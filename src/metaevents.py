@@ -9,8 +9,10 @@ An inactive or decomissioned column can be applied instead
 """
 
 from events import Event
+from schema import SchemaCache
 from psycopg2 import DatabaseError
-from utils import connect,disconnect,label_rows,update,DATABASE_ERROR
+from psycopg2.extras import execute_values
+from utils import connect,disconnect,release,label_rows,update,DATABASE_ERROR
 
 
 """Manages the creation, modification and viewing of entity types"""
@@ -22,120 +24,125 @@ class EntityType(Event):
     def __init__(self, db_config, user):
         super().__init__(db_config, user)
 
-    """Validates the incoming data for creating a new entitiy type and creates it"""
+    """Validates the incoming data for creating a new entitiy type and creates it, the entity type and its audit events commit together"""
     def add_entity_type(self, data):
         name = data.get('name')
 
         #Initial event definition
         event_details = {'event_type':'create_entity','entity_type':self.ENTITY_TYPE_NAME,'success':False,'attrs':data,'entity_name':self.ENTITY_INSTANCE_NAME}
-        
-        #Name validation
-        mssg = 'Missing entity name parameter'
-        self._validate_event_parameter(name,mssg,update(event_details,{'notes':mssg}))
 
-        #Insertion of entity type
-        conn = None
-        try:
-            conn,cur = connect(self._db_config)
-            cur.execute("""INSERT INTO entity_types(name,creator) VALUES(%s,%s)
-            ON CONFLICT ON CONSTRAINT entity_types_name_creator_key DO NOTHING RETURNING id""",(name,self._user))
+        with self._unit_of_work() as work:
+            #Name validation
+            mssg = 'Missing entity name parameter'
+            self._validate_event_parameter(name,mssg,update(event_details,{'notes':mssg}))
+
+            #Insertion of entity type
+            try:
+                with work.savepoint() as cur:
+                    cur.execute("""INSERT INTO entity_types(name,creator) VALUES(%s,%s)
+                    ON CONFLICT ON CONSTRAINT entity_types_name_creator_key DO NOTHING RETURNING id""",(name,self._user))
+                    result = cur.fetchone()
+
+                    #Listings of the user's types are cached by the version of their model
+                    if result is not None:
+                        SchemaCache.notify(cur,self._user)
+                        work.on_commit(lambda: SchemaCache.invalidate(self._user))
+
+            except DatabaseError:
+                self.add(update(event_details,{'notes':DATABASE_ERROR}))
+                raise Exception(DATABASE_ERROR,False,500)
 
             #Ensure entity does not already exist
             mssg = "Entity {0} Already Exists".format(name)
-            self._validate_event_parameter(cur.fetchone(),mssg,update(event_details,{'notes':mssg}))
+            self._validate_event_parameter(result,mssg,update(event_details,{'notes':mssg}))
 
-            conn.commit()
-            disconnect(conn,cur)
+            #Record that the creation of a new entity type happened
+            return self.add(update(event_details,{'name':name,'notes':"Entity Added",'success':True}))
 
-        except DatabaseError:
-            self.add(update(event_details,{'notes':DATABASE_ERROR}))
-            raise Exception(DATABASE_ERROR,False,500)
-        finally:
-            if conn is not None: conn.close()
-
-        #Record that the creation of a new entity type happened
-        return self.add(update(event_details,{'name':name,'notes':"Entity Added",'success':True}))
-           
 
-    """Add and remove event types the entity can perform"""
+    """
+    Add and remove event types the entity can perform, the changes and their audit events commit together
+    Names are resolved, added and removed in a fixed number of queries however many are sent. Returns which names were
+    added and removed and why each of the others was not
+    """
     def edit_entity_events(self, entity_type_name, data):
         to_add = data.get('to_add') or []
         to_remove = data.get('to_remove') or []
-        invalid_events = []
-        invalid_adds = removed = 0
+        invalid_adds = {}
+        invalid_removes = {}
 
         #Initial event definition
         event_details = {'event_type':'edit_entity_events','entity_type':self.ENTITY_TYPE_NAME,'success':False,'invalid_adds':0,'to_add':to_add,'to_remove':to_remove,'invalid_events':[],'entity_name':self.ENTITY_INSTANCE_NAME}
 
-        #Ensure the incoming to add and to remove are ina list format
-        if not (isinstance(to_add,list) and isinstance(to_remove,list)):
-            mssg = "Events must be in a comma separated list"
-            self.add(update(event_details,{'notes':mssg}))
-            raise Exception(mssg,False,400)
-        
-        #Insertion and removal of events
-        conn = None
-        try:
-            conn,cur = connect(self._db_config)
-            cur.execute("SELECT id FROM entity_types WHERE name = %s AND creator = %s", (entity_type_name,self._user))
-            result =  cur.fetchone()
-            
-            #Ensure entity exists
-            mssg = "Attempt to modify events of entity {0}, which does not exist".format(entity_type_name)
-            self._validate_event_parameter(result,mssg,update(event_details,{'notes':mssg}))
-            entity_id = result[0]
-
-            query_params = []
-            query = "INSERT INTO entity_events(entity_type,event_type)VALUES"
-            
-            #Loop through each event to add
-            for event_name in to_add:
-                cur.execute("SELECT id FROM event_types WHERE name = %s AND creator = %s", (event_name,self._user))
-                result =  cur.fetchone()
-
-                #TODO: Directly notify the user which events were invalid
-
-                #Ensure each event exists if not make a note of it
-                if result is None:
-                    invalid_adds+=1
-                    invalid_events.append(event_name)
-                    self.add(update(event_details,{'invalid_adds':invalid_adds}))
-                else:
-                    query_params.extend([entity_id,result[0]])
-                    query += "(%s,%s),"
-
-            #Only attempt to run the query once we have entities to add
-            if len(query_params) > 0:
-                query = query[:-1]
-                query += " ON CONFLICT ON CONSTRAINT entity_events_pkey DO NOTHING"
-                cur.execute(query, tuple(query_params))
-
-            #TODO: Diirectly notify the user which events were not deleted
-
-            #Generate query string for deletion
-            query_params = [entity_id]
-            query = "DELETE FROM entity_events WHERE entity_type = %s AND event_type IN (SELECT id FROM event_types WHERE"
-            for event_name in to_remove:
-                query += " (name = %s AND creator = %s) OR"
-                query_params.extend([event_name,self._user])
-
-            #Only remove events if there are events to remove and return the remove events to use as a count
-            if len(query_params) > 1:
-                query = query[:-2]+') RETURNING *'
-                cur.execute(query,tuple(query_params))
-                removed = cur.rowcount
-
-            conn.commit()
-            disconnect(conn,cur)
-
-        except DatabaseError:
-            self.add(update(event_details,{'notes':DATABASE_ERROR}))
-            raise Exception(DATABASE_ERROR,False,500)
-        finally:
-            if conn is not None: conn.close()
-
-        #Record that the modification of an entity type happened
-        return self.add(update(event_details,{'notes':"Entity Events Edited","success":True,'invalid_events':invalid_events,'removed':removed}))
+        with self._unit_of_work() as work:
+            #Ensure the incoming to add and to remove are lists of names
+            if not (isinstance(to_add,list) and isinstance(to_remove,list) and all(isinstance(name,str) for name in to_add+to_remove)):
+                mssg = "Events must be in a comma separated list"
+                self.add(update(event_details,{'notes':mssg}))
+                raise Exception(mssg,False,400)
+
+            #Names sent more than once are handled once, in the order first sent
+            to_add = list(dict.fromkeys(to_add))
+            to_remove = list(dict.fromkeys(to_remove))
+
+            #Insertion and removal of events
+            try:
+                with work.savepoint() as cur:
+                    cur.execute("SELECT id FROM entity_types WHERE name = %s AND creator = %s", (entity_type_name,self._user))
+                    result =  cur.fetchone()
+
+                #Ensure entity exists, outside the savepoint of the change so the failure is still audited
+                mssg = "Attempt to modify events of entity {0}, which does not exist".format(entity_type_name)
+                self._validate_event_parameter(result,mssg,update(event_details,{'notes':mssg}))
+                entity_id = result[0]
+
+                with work.savepoint() as cur:
+                    #Resolve every name to add or remove in one query
+                    cur.execute("SELECT name, id FROM event_types WHERE creator = %s AND name = ANY(%s)", (self._user,to_add+to_remove))
+                    event_ids = dict(cur.fetchall())
+                    event_names = {event_id:name for name,event_id in event_ids.items()}
+
+                    inserted = set()
+                    add_ids = [event_ids[name] for name in to_add if name in event_ids]
+                    if add_ids:
+                        cur.execute("""INSERT INTO entity_events(entity_type,event_type) SELECT %s, unnest(%s::INT[])
+                        ON CONFLICT ON CONSTRAINT entity_events_pkey DO NOTHING RETURNING event_type""", (entity_id,add_ids))
+                        inserted = {event_names[row[0]] for row in cur.fetchall()}
+
+                    deleted = set()
+                    remove_ids = [event_ids[name] for name in to_remove if name in event_ids]
+                    if remove_ids:
+                        cur.execute("DELETE FROM entity_events WHERE entity_type = %s AND event_type = ANY(%s) RETURNING event_type", (entity_id,remove_ids))
+                        deleted = {event_names[row[0]] for row in cur.fetchall()}
+
+                    if inserted or deleted:
+                        SchemaCache.notify(cur,self._user)
+                        work.on_commit(lambda: SchemaCache.invalidate(self._user))
+
+            except DatabaseError:
+                self.add(update(event_details,{'notes':DATABASE_ERROR}))
+                raise Exception(DATABASE_ERROR,False,500)
+
+            #Explain each name which was not added or removed
+            for name in to_add:
+                if name not in event_ids:
+                    invalid_adds[name] = "Event type does not exist"
+                elif name not in inserted:
+                    invalid_adds[name] = "Event type already belongs to the entity"
+            for name in to_remove:
+                if name not in event_ids:
+                    invalid_removes[name] = "Event type does not exist"
+                elif name not in deleted:
+                    invalid_removes[name] = "Event type does not belong to the entity"
+
+            added = [name for name in to_add if name in inserted]
+            removed = [name for name in to_remove if name in deleted]
+
+            #Record that the modification of an entity type happened
+            self.add(update(event_details,{'notes':"Entity Events Edited","success":True,'invalid_adds':len(invalid_adds),
+            'invalid_events':list(invalid_adds),'invalid_removes':list(invalid_removes),'removed':len(removed)}))
+
+        return {'added':added,'removed':removed,'invalid_adds':invalid_adds,'invalid_removes':invalid_removes},True,201
 
 
     """View all entity type's details takes optional parameter of the name of the entity type"""
@@ -169,7 +176,7 @@ class EntityType(Event):
         except DatabaseError:
             raise Exception(DATABASE_ERROR,False,500)
         finally:
-            if conn is not None: conn.close()
+            if conn is not None: release(conn)
         
         return {'entities_returned':count,'entities':label_rows(['name','events'],entities)},True,200
         
@@ -184,103 +191,93 @@ class EventType(Event):
     def __init__(self, db_config, user):
         super().__init__(db_config, user)
 
-    """Validates the incoming data for creating a new event type and creates it"""
+    """Validates the incoming data for creating a new event type and creates it, the event type and its audit events commit together"""
     def add_event_type(self, data):
         name = data.get('name')
-        
+
         #Initial event definition
         event_details = {'event_type':'create_event_type','entity_type':self.ENTITY_TYPE_NAME,'success':False,'name':name,'entity_name':self.ENTITY_INSTANCE_NAME}
-        
-        #Name validation
-        mssg = 'Missing event name parameter'
-        self._validate_event_parameter(name,mssg,update(event_details,{'notes':mssg}))
 
-        #Insertion of event type
-        conn = None
-        try:    
-            conn,cur = connect(self._db_config)
-            cur.execute("""INSERT INTO event_types(name,creator)VALUES(%s,%s) 
-            ON CONFLICT ON CONSTRAINT event_types_name_creator_key DO NOTHING RETURNING id""",(name,self._user))            
-            
+        with self._unit_of_work() as work:
+            #Name validation
+            mssg = 'Missing event name parameter'
+            self._validate_event_parameter(name,mssg,update(event_details,{'notes':mssg}))
+
+            #Insertion of event type
+            try:
+                with work.savepoint() as cur:
+                    cur.execute("""INSERT INTO event_types(name,creator)VALUES(%s,%s)
+                    ON CONFLICT ON CONSTRAINT event_types_name_creator_key DO NOTHING RETURNING id""",(name,self._user))
+                    result = cur.fetchone()
+
+                    #Listings of the user's types are cached by the version of their model
+                    if result is not None:
+                        SchemaCache.notify(cur,self._user)
+                        work.on_commit(lambda: SchemaCache.invalidate(self._user))
+
+            except DatabaseError:
+                self.add(update(event_details,{'notes':DATABASE_ERROR}))
+                raise Exception(DATABASE_ERROR,False,500)
+
             #Ensure event does not already exist
             mssg = "Event {0} Already Exists".format(name)
-            self._validate_event_parameter(cur.fetchone(),mssg,update(event_details,{'notes':mssg}))
-        
-            conn.commit()
-            disconnect(conn,cur)
-
-        except DatabaseError:
-            self.add(update(event_details,{'notes':DATABASE_ERROR}))
-            raise Exception(DATABASE_ERROR,False,500)
-        finally:
-            if conn is not None: conn.close()
+            self._validate_event_parameter(result,mssg,update(event_details,{'notes':mssg}))
 
-        #Record that the creation of a new event type happened
-        return self.add(update(event_details,{'notes':"Event Added",'success':True}))
+            #Record that the creation of a new event type happened
+            return self.add(update(event_details,{'notes':"Event Added",'success':True}))
 
     #TODO: More details on the event specific attributes could be stored such as required tags and default value
 
-    """Add and remove attributes from event types"""
-    def edit_event_type_attributes(self, event_type_name, data): 
+    """Add and remove attributes from event types, the changes and their audit events commit together"""
+    def edit_event_type_attributes(self, event_type_name, data):
         to_add = data.get('to_add') or []
         to_remove = data.get('to_remove') or []
-        event_specs = None
 
         #Initial event definition
         event_details = {'event_type':'edit_event_type_attributes','entity_type':self.ENTITY_TYPE_NAME,'success':False,'to_add':to_add,'to_remove':to_remove,'entity_name':self.ENTITY_INSTANCE_NAME}
 
-        #Ensure the incoming to add and to remove are ina list format
-        if not (isinstance(to_add,list) and isinstance(to_remove,list)):
-            mssg = "Attributes must be in a comma separated list"
-            self.add(update(event_details,{'notes':mssg}))
-            raise Exception(mssg,False,400)
+        with self._unit_of_work() as work:
+            #Ensure the incoming to add and to remove are ina list format
+            if not (isinstance(to_add,list) and isinstance(to_remove,list)):
+                mssg = "Attributes must be in a comma separated list"
+                self.add(update(event_details,{'notes':mssg}))
+                raise Exception(mssg,False,400)
 
-        #Select the event from the database
-        conn = None
-        try:
-            conn,cur = connect(self._db_config)
-            cur.execute("SELECT attrs,id FROM event_types WHERE creator = %s AND name = %s", (self._user,event_type_name))
-            event_specs = cur.fetchone()
-            disconnect(conn,cur)
+            try:
+                with work.savepoint() as cur:
+                    #Select the event from the database, locked so concurrent edits apply one after the other
+                    cur.execute("SELECT attrs,id FROM event_types WHERE creator = %s AND name = %s FOR UPDATE", (self._user,event_type_name))
+                    event_specs = cur.fetchone()
 
-        except DatabaseError:
-            self.add(update(event_details,{'notes':DATABASE_ERROR}))
-            raise(DATABASE_ERROR,False,500)
-        finally:
-            if conn is not None: conn.close()
+                #Ensure the event exists, outside the savepoint of the change so the failure is still audited
+                mssg = "Event {0} does not exist".format(event_type_name)
+                self._validate_event_parameter(event_specs,mssg,update(event_details,{'notes':mssg}))
 
-        #Ensure the event exists
-        mssg = "Event {0} does not exist".format(event_type_name)
-        self._validate_event_parameter(event_specs,mssg,update(event_details,{'notes':mssg}))
-        
-        #Cast the event's attributes to a set to ensure uniqueness of attributes
-        attributes = set(event_specs[0] or set())
-        event_id = event_specs[1]
-        
-        #TODO: Notify the user which attributes were not removed or how many were not
+                with work.savepoint() as cur:
+                    #Cast the event's attributes to a set to ensure uniqueness of attributes
+                    attributes = set(event_specs[0] or set())
+                    event_id = event_specs[1]
 
-        #Add and remoove new attributes respectively
-        for attr in to_add:
-            attributes.add(attr)
-        for attr in to_remove:
-            attributes.discard(attr)
+                    #TODO: Notify the user which attributes were not removed or how many were not
 
-        #Write new attributes list to the event
-        try:
-            conn,cur = connect(self._db_config)
-            cur.execute("UPDATE event_types SET attrs = %s WHERE id = %s", (list(attributes),event_id))
-            conn.commit()
-            disconnect(conn,cur)
-         
-        except DatabaseError:
-            self.add(update(event_details,{'notes':DATABASE_ERROR}))
-            raise Exception(DATABASE_ERROR,False,500)
-        finally:
-            if conn is not None: conn.close()
+                    #Add and remoove new attributes respectively
+                    for attr in to_add:
+                        attributes.add(attr)
+                    for attr in to_remove:
+                        attributes.discard(attr)
+
+                    #Write new attributes list to the event
+                    cur.execute("UPDATE event_types SET attrs = %s WHERE id = %s", (list(attributes),event_id))
+                    SchemaCache.notify(cur,self._user)
+                    work.on_commit(lambda: SchemaCache.invalidate(self._user))
+
+            except DatabaseError:
+                self.add(update(event_details,{'notes':DATABASE_ERROR}))
+                raise Exception(DATABASE_ERROR,False,500)
+
+            #Record that the modification of an event type happened
+            return self.add(update(event_details,{'to_add':to_add,'to_remove':to_remove,'notes':"Attributes Added",'success':True}))
 
-        #Record that the modification of an event type happened
-        return self.add(update(event_details,{'to_add':to_add,'to_remove':to_remove,'notes':"Attributes Added",'success':True}))
-        
 
     """View all event type's details takes optional parameter of the name of the event type"""
     def view_event_types(self, event_name=None):
@@ -307,6 +304,200 @@ class EventType(Event):
         except DatabaseError:
             raise(DATABASE_ERROR,False,500)
         finally:
-            if conn is not None: conn.close()
+            if conn is not None: release(conn)
         
         return {'events_returned':count,'events':label_rows(['name','attributes'],event_types)},True,200
+
+
+
+"""
+Applies a declarative model of a user's event types, their attributes, entity types and the event types each can perform
+Every change the model requires is made in one transaction and audited like the matching metaevent call, applying the
+same model again changes nothing. Types missing from the model are left as they are since types are never removed
+"""
+class Schema(Event):
+    #Default entity instances created on account instantiation which audit entity type and event type changes
+    ENTITY_TYPE_NAME = 'audit_metadata'
+    ENTITY_INSTANCE_NAME = 'main_entity_editor'
+    EVENT_INSTANCE_NAME = 'main_event_editor'
+
+    #Most entity types and event types a model may declare together
+    MAX_SCHEMA_TYPES = 10000
+
+    def __init__(self, db_config, user):
+        super().__init__(db_config, user)
+
+    """
+    Brings the user's types in line with the model and returns what changed
+    @param data: {'event_types': {event type name: [attributes]}, 'entity_types': {entity type name: [event type names]}}
+    """
+    def apply(self, data):
+        event_types,entity_types = self._model_types(data)
+
+        with self._unit_of_work() as work:
+            try:
+                with work.savepoint() as cur:
+                    #Models applied concurrently by the same user are applied one after the other
+                    cur.execute("SELECT pg_advisory_xact_lock(hashtext('apply_schema'), %s)",(self._user,))
+                    current_events,current_entities = self._current_types(cur, event_types, entity_types)
+
+                    unknown = sorted({name for events in entity_types.values() for name in events if name not in event_types and name not in current_events})
+                    if unknown:
+                        raise Exception("Unknown event type(s): {0}".format(', '.join(unknown)),False,400)
+
+                    diff = self._diff(event_types, entity_types, current_events, current_entities)
+                    if diff['changes'] > 0:
+                        #Audit events are added first, while the model they are validated against is unchanged, and no
+                        #change is made unless every one of them was recorded
+                        report = self._insert_batch(cur, self._audit_events(diff))
+                        failed = [item['result'] for item in report if not item['success']]
+                        if failed:
+                            raise Exception("Schema changes could not be audited: {0}".format(failed[0]),False,500)
+                        self._apply_diff(cur, diff, event_types, current_events, current_entities)
+                        SchemaCache.notify(cur,self._user)
+                        work.on_commit(lambda: SchemaCache.invalidate(self._user))
+
+            except DatabaseError:
+                raise Exception(DATABASE_ERROR,False,500)
+
+        return diff,True,200
+
+
+    """Validates a model, returning its event types and entity types with the names in each list made unique"""
+    def _model_types(self, data):
+        mssg = "Schema must map event type names to lists of attributes and entity type names to lists of event type names"
+        if not isinstance(data, dict):
+            raise Exception(mssg,False,400)
+
+        types = []
+        for key in ('event_types','entity_types'):
+            declared = data.get(key) or {}
+            if not isinstance(declared, dict):
+                raise Exception(mssg,False,400)
+            for name,names in declared.items():
+                if not name or not isinstance(names, list) or not all(isinstance(item, str) for item in names):
+                    raise Exception(mssg,False,400)
+            types.append({name:list(dict.fromkeys(names)) for name,names in declared.items()})
+
+        if len(types[0])+len(types[1]) > self.MAX_SCHEMA_TYPES:
+            raise Exception("A schema can declare at most {0} types".format(self.MAX_SCHEMA_TYPES),False,400)
+        return types
+
+
+    """
+    Reads the current state of every type the model names in one query
+    Returns {event type name: (id, attributes)} and {entity type name: (id, {event type name: event type id})}
+    """
+    def _current_types(self, cur, event_types, entity_types):
+        event_names = set(event_types).union(*entity_types.values())
+        cur.execute("""SELECT 'event_type', id, name, attrs, NULL::INT[] FROM event_types
+        WHERE creator = %(user)s AND name = ANY(%(events)s)
+        UNION ALL
+        SELECT 'entity_type', entity_types.id, entity_types.name,
+        array_remove(array_agg(event_types.name), NULL), array_remove(array_agg(event_types.id), NULL)
+        FROM entity_types
+        LEFT JOIN entity_events ON entity_events.entity_type = entity_types.id
+        LEFT JOIN event_types ON event_types.id = entity_events.event_type
+        WHERE entity_types.creator = %(user)s AND entity_types.name = ANY(%(entities)s)
+        GROUP BY entity_types.id""",{'user':self._user,'events':list(event_names),'entities':list(entity_types)})
+
+        current_events = {}
+        current_entities = {}
+        for kind,type_id,name,names,ids in cur.fetchall():
+            if kind == 'event_type':
+                current_events[name] = (type_id,names or [])
+            else:
+                current_entities[name] = (type_id,dict(zip(names,ids)))
+        return current_events,current_entities
+
+
+    """The types to create, attributes to change and event types to add to or remove from entity types to reach the model"""
+    @staticmethod
+    def _diff(event_types, entity_types, current_events, current_entities):
+        attributes = {}
+        for name,attrs in event_types.items():
+            current = current_events[name][1] if name in current_events else []
+            added = [attr for attr in attrs if attr not in current]
+            removed = sorted(set(current)-set(attrs))
+            if added or removed:
+                attributes[name] = {'added':added,'removed':removed}
+
+        entity_events = {}
+        for name,events in entity_types.items():
+            current = current_entities[name][1] if name in current_entities else {}
+            added = [event for event in events if event not in current]
+            removed = sorted(set(current)-set(events))
+            if added or removed:
+                entity_events[name] = {'added':added,'removed':removed}
+
+        created_events = [name for name in event_types if name not in current_events]
+        created_entities = [name for name in entity_types if name not in current_entities]
+        return {
+            'changes':len(created_events)+len(attributes)+len(created_entities)+len(entity_events),
+            'event_types':{'created':created_events,'attributes':attributes},
+            'entity_types':{'created':created_entities,'event_types':entity_events}
+        }
+
+
+    """The events auditing a diff, one for each change the matching metaevent call would have audited"""
+    def _audit_events(self, diff):
+        audit = {'entity_type':self.ENTITY_TYPE_NAME,'success':True}
+        events = []
+        for name in diff['event_types']['created']:
+            events.append(update(dict(audit),{'event_type':'create_event_type','entity_name':self.EVENT_INSTANCE_NAME,'name':name,'notes':"Event Added"}))
+        for name,change in diff['event_types']['attributes'].items():
+            events.append(update(dict(audit),{'event_type':'edit_event_type_attributes','entity_name':self.EVENT_INSTANCE_NAME,'name':name,
+            'to_add':change['added'],'to_remove':change['removed'],'notes':"Attributes Added"}))
+        for name in diff['entity_types']['created']:
+            events.append(update(dict(audit),{'event_type':'create_entity','entity_name':self.ENTITY_INSTANCE_NAME,'name':name,'notes':"Entity Added"}))
+        for name,change in diff['entity_types']['event_types'].items():
+            events.append(update(dict(audit),{'event_type':'edit_entity_events','entity_name':self.ENTITY_INSTANCE_NAME,'name':name,
+            'to_add':change['added'],'to_remove':change['removed'],'removed':len(change['removed']),'notes':"Entity Events Edited"}))
+        return events
+
+
+    """Makes the changes of a diff with one statement per kind of change"""
+    def _apply_diff(self, cur, diff, event_types, current_events, current_entities):
+        event_ids = {name:event_id for name,(event_id,_) in current_events.items()}
+        entity_ids = {name:entity_id for name,(entity_id,_) in current_entities.items()}
+
+        created = diff['event_types']['created']
+        if created:
+            event_ids.update(execute_values(cur, """INSERT INTO event_types(name,creator,attrs) VALUES %s
+            ON CONFLICT ON CONSTRAINT event_types_name_creator_key DO NOTHING RETURNING name,id""",
+            [(name,self._user,event_types[name]) for name in created], template="(%s,%s,%s::TEXT[])", page_size=len(created), fetch=True))
+
+        #Types created by a concurrent metaevent call after the model was read are changed to match it
+        concurrent = [name for name in created if name not in event_ids]
+        if concurrent:
+            cur.execute("SELECT name, id FROM event_types WHERE creator = %s AND name = ANY(%s)",(self._user,concurrent))
+            event_ids.update(cur.fetchall())
+
+        changed = [name for name in diff['event_types']['attributes'] if name not in created]+concurrent
+        if changed:
+            execute_values(cur, """UPDATE event_types SET attrs = changes.attrs FROM (VALUES %s) AS changes(id, attrs)
+            WHERE event_types.id = changes.id""",
+            [(event_ids[name],event_types[name]) for name in changed], template="(%s,%s::TEXT[])", page_size=len(changed))
+
+        created = diff['entity_types']['created']
+        if created:
+            entity_ids.update(execute_values(cur, """INSERT INTO entity_types(name,creator) VALUES %s
+            ON CONFLICT ON CONSTRAINT entity_types_name_creator_key DO NOTHING RETURNING name,id""",
+            [(name,self._user) for name in created], page_size=len(created), fetch=True))
+
+        concurrent = [name for name in created if name not in entity_ids]
+        if concurrent:
+            cur.execute("SELECT name, id FROM entity_types WHERE creator = %s AND name = ANY(%s)",(self._user,concurrent))
+            entity_ids.update(cur.fetchall())
+
+        removed = [(entity_ids[name],current_entities[name][1][event]) for name,change in diff['entity_types']['event_types'].items()
+        for event in change['removed']]
+        if removed:
+            execute_values(cur, """DELETE FROM entity_events USING (VALUES %s) AS removed(entity_type, event_type)
+            WHERE entity_events.entity_type = removed.entity_type AND entity_events.event_type = removed.event_type""",
+            removed, page_size=len(removed))
+
+        added = [(entity_ids[name],event_ids[event]) for name,change in diff['entity_types']['event_types'].items() for event in change['added']]
+        if added:
+            execute_values(cur, """INSERT INTO entity_events(entity_type,event_type) VALUES %s
+            ON CONFLICT ON CONSTRAINT entity_events_pkey DO NOTHING""", added, page_size=len(added))
@@ -0,0 +1,63 @@
+"""Periodic maintenance of the time partitions of the events table"""
+
+import threading
+from datetime import timedelta
+from psycopg2 import DatabaseError
+from utils import connect,disconnect,release
+from querycache import get_query_cache
+
+
+"""
+Background thread which creates upcoming partitions of events and removes expired ones by calling maintain_event_partitions
+The database function serialises concurrent runs so every server may run one
+When given an archive, partitions older than archive_after are then moved into it
+"""
+class PartitionMaintainer(threading.Thread):
+    def __init__(self, db_config: dict, interval: float=3600.0, archive=None, archive_after: timedelta=None):
+        super().__init__(name='partition-maintainer', daemon=True)
+        self._db_config = db_config
+        self._interval = interval
+        self._archive = archive
+        self._archive_after = archive_after
+        self._stopped = threading.Event()
+
+    def stop(self):
+        self._stopped.set()
+
+    def run(self):
+        while not self._stopped.is_set():
+            if self.maintain() and self._archive is not None:
+                self.archive()
+            self._stopped.wait(self._interval)
+
+    """Runs one round of maintenance, returning whether it succeeded"""
+    def maintain(self) -> bool:
+        conn = None
+        try:
+            conn,cur = connect(self._db_config)
+            cur.execute("SELECT maintain_event_partitions()")
+            conn.commit()
+            disconnect(conn,cur)
+
+            #Expired events may have been removed, which no cached view result accounts for
+            query_cache = get_query_cache()
+            if query_cache is not None:
+                query_cache.clear()
+            return True
+
+        except DatabaseError as error:
+            print("Event partition maintenance failed: {0}".format(error))
+            return False
+        finally:
+            if conn is not None: release(conn)
+
+    """Moves partitions older than archive_after into the archive, returning whether it succeeded"""
+    def archive(self) -> bool:
+        try:
+            archived = self._archive.archive_partitions(self._db_config, self._archive_after)
+            if archived:
+                print("Archived {0} event partition(s)".format(archived))
+            return True
+        except (DatabaseError, OSError) as error:
+            print("Event partition archival failed: {0}".format(error))
+            return False
@@ -0,0 +1,178 @@
+"""Thread safe pool of long lived database connections shared by every caller of utils.connect"""
+
+import time
+import threading
+import psycopg2
+from psycopg2 import extensions, DatabaseError, OperationalError
+
+
+"""Raised when no connection could be checked out before the checkout timeout expired"""
+class PoolTimeout(OperationalError):
+    pass
+
+
+"""Bounded pool of connections with idle expiry, health checks on reuse and a checkout timeout"""
+class ConnectionPool:
+    #Settings read from the [postgresql] section which configure the pool rather than the connection
+    SETTINGS = {
+        'pool_min_size': (int, 1),
+        'pool_max_size': (int, 10),
+        'pool_idle_timeout': (float, 300.0),        #Seconds an idle connection above the minimum is kept open
+        'pool_checkout_timeout': (float, 30.0),     #Seconds to wait for a free connection before failing
+        'pool_health_check_interval': (float, 30.0) #Idle seconds after which a connection is pinged before reuse
+    }
+
+    def __init__(self, conn_params: dict, min_size=1, max_size=10, idle_timeout=300.0, checkout_timeout=30.0, health_check_interval=30.0):
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError('Invalid pool size ({0},{1})'.format(min_size, max_size))
+
+        self._conn_params = conn_params
+        self._min_size = min_size
+        self._max_size = max_size
+        self._idle_timeout = idle_timeout
+        self._checkout_timeout = checkout_timeout
+        self._health_check_interval = health_check_interval
+
+        self._idle = []          #Stack of (connection, time returned) available for checkout
+        self._in_use = set()     #Ids of connections currently checked out
+        self._size = 0           #Open connections, both idle and in use
+        self._closed = False
+        self._lock = threading.Condition()
+
+
+    """Creates a pool from a configuration dictionary, separating pool settings from connection parameters"""
+    @classmethod
+    def from_config(cls, config: dict):
+        conn_params = {key:value for key,value in config.items() if key not in cls.SETTINGS}
+        settings = {key[5:]:cast(config.get(key, default)) for key,(cast,default) in cls.SETTINGS.items()}
+        return cls(conn_params, **settings)
+
+    @property
+    def size(self):
+        return self._size
+
+    @property
+    def idle(self):
+        return len(self._idle)
+
+    @property
+    def in_use(self):
+        return len(self._in_use)
+
+
+    """Checks out a healthy connection, opening a new one if below the maximum size and waiting otherwise"""
+    def getconn(self):
+        deadline = time.monotonic() + self._checkout_timeout
+
+        while True:
+            conn = None
+            with self._lock:
+                if self._closed:
+                    raise PoolTimeout('Connection pool is closed')
+
+                self._close_expired()
+
+                while not self._idle and self._size >= self._max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise PoolTimeout('Timed out waiting for a database connection')
+                    self._lock.wait(remaining)
+
+                if self._idle:
+                    conn,returned = self._idle.pop()
+                else:
+                    #Reserve the slot before connecting so the lock is not held during the handshake
+                    self._size += 1
+                    returned = None
+
+            if returned is None:
+                try:
+                    conn = psycopg2.connect(**self._conn_params)
+                except DatabaseError:
+                    self._discard(None)
+                    raise
+            elif not self._is_healthy(conn, returned):
+                self._discard(conn)
+                continue
+
+            with self._lock:
+                self._in_use.add(id(conn))
+            return conn
+
+
+    """Returns a connection to the pool, rolling back any open transaction. Returning a connection twice is a no-op"""
+    def putconn(self, conn):
+        with self._lock:
+            if id(conn) not in self._in_use:
+                return
+            self._in_use.discard(id(conn))
+
+        try:
+            if not conn.closed and conn.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+        except DatabaseError:
+            pass
+
+        if conn.closed or self._closed:
+            self._discard(conn)
+            return
+
+        with self._lock:
+            self._idle.append((conn,time.monotonic()))
+            self._lock.notify()
+
+
+    """Closes every idle connection, connections in use are closed when they are returned"""
+    def close(self):
+        with self._lock:
+            self._closed = True
+            idle,self._idle = self._idle,[]
+            self._size -= len(idle)
+            self._lock.notify_all()
+
+        for conn,_ in idle:
+            conn.close()
+
+
+    def _is_healthy(self, conn, returned):
+        if conn.closed:
+            return False
+        if time.monotonic() - returned < self._health_check_interval:
+            return True
+
+        try:
+            with conn.cursor() as cur:
+                cur.execute('SELECT 1')
+            conn.rollback()
+            return True
+        except DatabaseError:
+            return False
+
+
+    def _discard(self, conn):
+        if conn is not None and not conn.closed:
+            try:
+                conn.close()
+            except DatabaseError:
+                pass
+
+        with self._lock:
+            self._size -= 1
+            self._lock.notify()
+
+
+    """Closes connections idle for longer than the idle timeout while keeping the minimum size open, lock must be held"""
+    def _close_expired(self):
+        now = time.monotonic()
+        keep = []
+
+        #Idle connections are stored oldest first
+        for position,(conn,returned) in enumerate(self._idle):
+            if now - returned > self._idle_timeout and self._size > self._min_size:
+                self._size -= 1
+                conn.close()
+            else:
+                keep = self._idle[position:]
+                break
+
+        self._idle = keep
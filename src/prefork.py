@@ -0,0 +1,115 @@
+"""Pre-fork process supervisor which shares one listening socket between a fixed number of worker processes"""
+
+import os
+import time
+import signal
+import socket
+import threading
+from utils import close_pools
+
+
+"""
+Forks worker processes which each accept connections from the inherited listening socket
+Crashed workers are replaced and on SIGTERM or SIGINT every worker is asked to finish its in flight requests and exit
+"""
+class PreforkSupervisor:
+    #Workers exiting sooner than this after starting are restarted with a delay to avoid a tight crash loop
+    MIN_WORKER_LIFETIME = 1.0
+
+    def __init__(self, address, make_server, processes: int, drain_timeout: float=30.0, backlog: int=128):
+        self._make_server = make_server #Called in each worker with (listening socket, worker slot) and returns a server
+        self._processes = processes
+        self._drain_timeout = drain_timeout
+
+        #Non blocking so a worker which loses the race to accept a connection returns to its select loop
+        self._listener = socket.create_server(address, backlog=backlog)
+        self._listener.setblocking(False)
+
+        self._workers = {} #pid: (slot, start time)
+        self._stopping = False
+
+    @property
+    def address(self):
+        return self._listener.getsockname()
+
+
+    """Starts every worker and supervises them until asked to stop"""
+    def serve_forever(self):
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+
+        for slot in range(self._processes):
+            self._spawn(slot)
+
+        while self._workers and not self._stopping:
+            try:
+                pid,status = os.wait()
+            except ChildProcessError:
+                break
+            if pid not in self._workers:
+                continue
+
+            slot,started = self._workers.pop(pid)
+            if self._stopping:
+                break
+
+            print("Worker {0} (pid {1}) exited with status {2}, restarting".format(slot, pid, os.waitstatus_to_exitcode(status)))
+            if time.monotonic() - started < self.MIN_WORKER_LIFETIME:
+                time.sleep(self.MIN_WORKER_LIFETIME)
+            if not self._stopping:
+                self._spawn(slot)
+
+        self._drain()
+        self._listener.close()
+
+
+    def _stop(self, signum, frame):
+        self._stopping = True
+        for pid in self._workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+
+    """Waits for the workers to finish their in flight requests, killing any still running after the drain timeout"""
+    def _drain(self):
+        deadline = time.monotonic() + self._drain_timeout
+        while self._workers and time.monotonic() < deadline:
+            pid,_ = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                time.sleep(0.05)
+            else:
+                self._workers.pop(pid, None)
+
+        for pid in self._workers:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+        self._workers.clear()
+
+
+    def _spawn(self, slot):
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                code = self._run_worker(slot)
+            finally:
+                os._exit(code)
+        self._workers[pid] = (slot, time.monotonic())
+
+
+    """Worker process body, serves requests until SIGTERM then drains and returns the exit code"""
+    def _run_worker(self, slot):
+        signal.signal(signal.SIGINT, signal.SIG_IGN) #Terminal interrupts reach the supervisor which stops the workers
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+        server = self._make_server(self._listener, slot)
+        signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown).start())
+
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            close_pools()
+        return 0
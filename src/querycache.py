@@ -0,0 +1,88 @@
+"""
+In-process cache of the results of event views, so dashboards repeating the same query are answered without the database
+Results are stamped with the version of the user's events they were read at, which every write of the user's events in
+this process bumps once it has committed
+"""
+
+import json
+import time
+import threading
+from cache import SizedLRUCache
+
+
+"""
+Results of event views keyed by user, entity name, page size and the remaining filters, bounded by their serialised size
+A result is current while the user's version is unchanged, results of views over relative time ranges such as "last 1h"
+change with the clock and are only served to clients accepting a result of a given age, as are every result when the
+cache is not versioned because other processes write events too
+"""
+class QueryCache:
+    def __init__(self, max_bytes: int, ttl: float=60.0, versioned: bool=True):
+        self._results = SizedLRUCache(max_bytes, ttl)
+        self._versioned = versioned
+        self._versions = {}
+        self._generation = 0
+        self._hits = 0
+        self._misses = 0
+        self._lock = threading.Lock()
+
+    """Key of an event view, filters are serialised with sorted keys so the same filters sent in any order share it"""
+    @staticmethod
+    def key(user, entity_name, limit, filters: dict):
+        return (user, entity_name, limit, json.dumps(filters, sort_keys=True, default=str))
+
+    """Version of the user's events, changed by every write of them and by clear"""
+    def version(self, user):
+        with self._lock:
+            return (self._generation, self._versions.get(user, 0))
+
+    """Makes the user's cached results stale, called once new events of theirs have committed"""
+    def bump(self, user):
+        with self._lock:
+            self._versions[user] = self._versions.get(user, 0) + 1
+
+    """Makes every cached result stale, called once events have been removed such as by retention"""
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+        self._results.clear()
+
+    """
+    Returns the cached result of a view if it is current, or not older than max_age seconds when the client accepts that
+    @param versioned: whether the view's result only changes when the user's events do
+    """
+    def get(self, key, user, versioned: bool, max_age: float=None):
+        entry = self._results.get(key)
+        current = entry is not None and (
+            (versioned and self._versioned and entry[0] == self.version(user)) or
+            (max_age is not None and time.monotonic()-entry[1] <= max_age))
+
+        with self._lock:
+            if current:
+                self._hits += 1
+            else:
+                self._misses += 1
+        return entry[2] if current else None
+
+    """Caches a result read at the given version, a result read while the user's events changed is never served as current"""
+    def set(self, key, version, result: dict):
+        self._results.set(key, (version, time.monotonic(), result), len(json.dumps(result, default=str)))
+
+    def metrics(self) -> dict:
+        with self._lock:
+            lookups = self._hits+self._misses
+            metrics = {'hits':self._hits,'misses':self._misses,'hit_ratio':round(self._hits/lookups, 3) if lookups else 0}
+        metrics.update(self._results.usage())
+        return metrics
+
+
+#Cache of event view results, None unless the server was started with a query cache size
+_query_cache = None
+
+def configure_query_cache(max_bytes: int, ttl: float=60.0, versioned: bool=True) -> QueryCache:
+    global _query_cache
+    _query_cache = QueryCache(max_bytes, ttl, versioned)
+    return _query_cache
+
+def get_query_cache():
+    return _query_cache
@@ -0,0 +1,138 @@
+"""
+Hourly and daily rollups of event counts read by event stats
+Inserted events are counted into deltas by a trigger, compaction folds the deltas into the rollups and a rebuild
+recounts them from the events, for backfills of events added before the rollups existed
+Usage: DATABASE_INI=... python3 rollups.py [user_id] [--archive-dir directory]
+"""
+
+import sys
+import argparse
+import threading
+import collections
+from psycopg2 import DatabaseError
+from psycopg2.extras import execute_values
+from utils import config,connect,disconnect,release
+from archive import Archive
+
+
+"""
+Background thread which folds the deltas of newly inserted events into the rollups and into the latest event of each
+entity instance by calling compact_event_rollups and compact_entity_latest_events
+"""
+class RollupCompactor(threading.Thread):
+    def __init__(self, db_config: dict, interval: float=10.0):
+        super().__init__(name='rollup-compactor', daemon=True)
+        self._db_config = db_config
+        self._interval = interval
+        self._stopped = threading.Event()
+
+    def stop(self):
+        self._stopped.set()
+
+    def run(self):
+        while not self._stopped.wait(self._interval):
+            self.compact()
+
+    """Runs one compaction, returning whether it succeeded"""
+    def compact(self) -> bool:
+        conn = None
+        try:
+            conn,cur = connect(self._db_config)
+            cur.execute("SELECT compact_event_rollups()")
+            conn.commit()
+            cur.execute("SELECT compact_entity_latest_events()")
+            conn.commit()
+            disconnect(conn,cur)
+            return True
+
+        except DatabaseError as error:
+            print("Event rollup compaction failed: {0}".format(error))
+            return False
+        finally:
+            if conn is not None: release(conn)
+
+
+"""
+Recounts the rollups of one user, or of every user, from their events and the events in the archive
+The recount reads a single snapshot in which every event is either counted or still has its delta pending, so
+events inserted during the rebuild are neither lost nor counted twice. Returns the number of hourly rollups written
+"""
+def rebuild_rollups(db_config: dict, user: int=None, archive: Archive=None) -> int:
+    conn = None
+    try:
+        conn,cur = connect(db_config)
+        #The session lock is taken before the snapshot so no compaction commits within it
+        cur.execute("SELECT pg_advisory_lock(hashtext('event_rollups'))")
+        conn.commit()
+        try:
+            cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+            for table in ('event_rollups_hour','event_rollups_day','event_rollup_deltas'):
+                cur.execute("DELETE FROM "+table+" WHERE %(user)s::INT IS NULL OR creator = %(user)s",{'user':user})
+
+            cur.execute("""INSERT INTO event_rollups_hour(creator, bucket, event_type, entity_type, success, events)
+            SELECT events.creator, date_trunc('hour', events.time), events.type, entity_instances.type, events.success, count(*)
+            FROM events LEFT JOIN entity_instances ON entity_instances.id = events.entity_id
+            WHERE %(user)s::INT IS NULL OR events.creator = %(user)s
+            GROUP BY 1, 2, 3, 4, 5""",{'user':user})
+            rollups = cur.rowcount
+
+            if archive is not None:
+                rollups += _add_archived(cur, archive, user)
+
+            cur.execute("""INSERT INTO event_rollups_day(creator, bucket, event_type, entity_type, success, events)
+            SELECT creator, date_trunc('day', bucket), event_type, entity_type, success, sum(events) FROM event_rollups_hour
+            WHERE %(user)s::INT IS NULL OR creator = %(user)s
+            GROUP BY 1, 2, 3, 4, 5""",{'user':user})
+            conn.commit()
+        finally:
+            conn.rollback()
+            cur.execute("SELECT pg_advisory_unlock(hashtext('event_rollups'))")
+            conn.commit()
+
+        disconnect(conn,cur)
+        return rollups
+    finally:
+        if conn is not None: release(conn)
+
+
+"""Adds the counts of archived events to the hourly rollups, returning the number of rollups written"""
+def _add_archived(cur, archive: Archive, user: int=None) -> int:
+    tenants = {tenant for segment in archive.segments() for tenant in segment['tenants']}
+    if user is not None:
+        tenants &= {str(user)}
+
+    counts = collections.Counter()
+    for tenant in tenants:
+        query = {'user':tenant,'entity_name':None,'from':None,'to':None,'cursor':None,'columns':{},'data':{},'operators':{}}
+        for row in archive.events(query):
+            counts[(int(tenant),row[7].replace(minute=0,second=0,microsecond=0),row[1],row[2],row[4])] += 1
+    if not counts:
+        return 0
+
+    #Archived events hold the id of their entity, its type is read from the entity instances which are never archived
+    cur.execute("SELECT id, type FROM entity_instances WHERE id = ANY(%s)",(sorted({key[3] for key in counts}),))
+    entity_types = dict(cur.fetchall())
+
+    rollups = collections.Counter()
+    for (creator,bucket,event_type,entity_id,success),count in counts.items():
+        rollups[(creator,bucket,event_type,entity_types.get(entity_id),success)] += count
+
+    execute_values(cur, """INSERT INTO event_rollups_hour(creator, bucket, event_type, entity_type, success, events) VALUES %s
+    ON CONFLICT (creator, bucket, event_type, entity_type, success) DO UPDATE SET events = event_rollups_hour.events + EXCLUDED.events""",
+    [key+(count,) for key,count in rollups.items()])
+    return len(rollups)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Rebuild the rollups of event counts read by event stats')
+    parser.add_argument('user', nargs='?', type=int, help='Id of the user whose rollups are rebuilt, every user by default')
+    parser.add_argument('--archive-dir', help='Directory of the archive of old events, whose events are counted as well')
+    args = parser.parse_args()
+
+    archive = Archive(args.archive_dir) if args.archive_dir is not None else None
+    try:
+        rollups = rebuild_rollups(config(), args.user, archive)
+    except DatabaseError as error:
+        print("Event rollup rebuild failed: {0}".format(error))
+        sys.exit(1)
+    print("Rebuilt {0} hourly event rollups".format(rollups))
@@ -3,14 +3,25 @@ Single class file which accepts authorization details and routes requests to the
 using defined router functions
 """
 
-from metaevents import EntityType,EventType
+from metaevents import EntityType,EventType,Schema
 from events import Event
 from authorization import Authorizer
+from journal import get_journal
+from querycache import get_query_cache
+from schema import SchemaCache,ListingCache
 from utils import INTERNAL_ERROR
 
 
+#Ids of the operators allowed to view server metrics, which cover the events of every user, none unless the server was started with them
+_metrics_users = frozenset()
+
+def configure_metrics_users(users):
+    global _metrics_users
+    _metrics_users = frozenset(users or [])
+
+
 class Route():
-    def __init__(self, auth_manager:Authorizer, data, db_config, params):
+    def __init__(self, auth_manager:Authorizer, data, db_config, params, headers=None):
         self._auth_manager = auth_manager
         self._user = auth_manager.user
         self._type = auth_manager.type
@@ -20,6 +31,10 @@ class Route():
 
         self._data = data
         self._db_config = db_config
+        self._headers = headers or {}
+
+        #Entity tag of the response, set by routes serving conditional requests
+        self.etag = None
 
     """Router function for registration"""
     @staticmethod
@@ -69,35 +84,111 @@ class Route():
         event_type_manager=EventType(self._db_config, self._user)
         return event_type_manager.edit_event_type_attributes(self._params[0],self._data)
 
+    def post_schema(self):
+        self.ensure_bearer()
+        schema_manager=Schema(self._db_config, self._user)
+        return schema_manager.apply(self._data)
+
+    """Determines if the client asked for the request to be processed asynchronously (RFC 7240) and the server can do so"""
+    def prefers_async(self):
+        preferences = [preference.strip().lower() for preference in (self._headers.get('Prefer') or '').split(',')]
+        return 'respond-async' in preferences and get_journal() is not None
+
+    """Reads the age of a cached response the client accepts from the max-age directive of its Cache-Control header"""
+    def max_age(self):
+        for directive in (self._headers.get('Cache-Control') or '').split(','):
+            name,_,value = directive.strip().partition('=')
+            if name.lower() == 'max-age':
+                try:
+                    return max(0, int(value.strip('"')))
+                except ValueError:
+                    return None
+        return None
+
     def post_event(self):
         self.ensure_bearer()
         event_manager=Event(self._db_config, self._user)
+        if self.prefers_async():
+            return event_manager.add_async(self._data, get_journal())
         return event_manager.add(self._data)
 
+    def post_event_batch(self):
+        self.ensure_bearer()
+        event_manager=Event(self._db_config, self._user)
+        return event_manager.add_batch(self._data)
+
     
     def get_token(self):
         self.ensure_basic()
         return self._auth_manager.generate_token(self._data)
 
+    """
+    Serves a listing tagged with its entity tag, from the listing cache when a key is given and the cached entry is current
+    A listing whose tag is sent in If-None-Match is answered with 304 and no body, without a database call when cached
+    """
+    def conditional(self, load, key=None):
+        cached = ListingCache.get(self._user, key) if key is not None else None
+        if cached is not None:
+            result,self.etag = cached
+            success,code = True,200
+        else:
+            version = SchemaCache.version(self._user)
+            result,success,code = load()
+            self.etag = ListingCache.etag(result)
+            if key is not None:
+                ListingCache.set(self._user, key, version, result, self.etag)
+
+        if self.etag_matches():
+            return None,True,304
+        return result,success,code
+
+    """Whether the If-None-Match header names the response's entity tag, weak comparison as RFC 9110 requires for GET"""
+    def etag_matches(self):
+        header = self._headers.get('If-None-Match')
+        if header is None or self.etag is None:
+            return False
+        tags = [tag.strip() for tag in header.split(',')]
+        return '*' in tags or self.etag in [tag[2:] if tag.startswith('W/') else tag for tag in tags]
+
     def get_entity_types(self):
         self.ensure_bearer()
         entity_type_manager=EntityType(self._db_config, self._user)
-        return entity_type_manager.view_entity_types(self._params[0] if self._num_params>0 else None)
+        name = self._params[0] if self._num_params>0 else None
+        return self.conditional(lambda: entity_type_manager.view_entity_types(name), ('entity_types',name))
 
     def get_event_types(self):
         self.ensure_bearer()
         event_type_manager=EventType(self._db_config, self._user)
-        return event_type_manager.view_event_types(self._params[0] if self._num_params>0 else None)
+        name = self._params[0] if self._num_params>0 else None
+        return self.conditional(lambda: event_type_manager.view_event_types(name), ('event_types',name))
 
+    #Entity instances are not cached as their latest events change with every event added
     def get_entities(self):
         self.ensure_bearer()
         event_manager=Event(self._db_config, self._user)
-        return event_manager.view_entity_instances()
+        return self.conditional(lambda: event_manager.view_entity_instances(self._data))
 
     def get_events(self):
         self.ensure_bearer()
         event_manager=Event(self._db_config, self._user)
-        return event_manager.view(self._data, self._params[0] if self._num_params>0 else None)
+        if isinstance(self._data, dict) and 'stream' in self._data:
+            filters = dict(self._data)
+            return event_manager.stream(filters, self._params[0] if self._num_params>0 else None, filters.pop('stream'))
+        return event_manager.view(self._data, self._params[0] if self._num_params>0 else None, self.max_age())
+
+    def get_event_stats(self):
+        self.ensure_bearer()
+        event_manager=Event(self._db_config, self._user)
+        return event_manager.stats(self._data)
+
+    def get_metrics(self):
+        self.ensure_bearer()
+        if self._user not in _metrics_users:
+            raise Exception('Server metrics are only available to operators',False,403)
+        journal = get_journal()
+        query_cache = get_query_cache()
+        return {'journal':journal.metrics() if journal is not None else None,
+        'query_cache':query_cache.metrics() if query_cache is not None else None},True,200
 
     """
     Checks authoorization of requested and executes the appropriate router fn
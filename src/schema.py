@@ -0,0 +1,157 @@
+"""
+Per user cache of the entity event model used to validate incoming events without querying the database and of the
+listings of entity types and event types served from it
+"""
+
+import os
+import json
+import select
+import hashlib
+import threading
+import psycopg2
+from psycopg2 import DatabaseError
+from cache import LRUCache
+from pool import ConnectionPool
+
+#Channel metaevent changes are announced on, the payload is the id of the user whose model changed
+SCHEMA_CHANNEL = 'schema_changed'
+
+
+"""
+Maps each user's (entity type name, event type name) pairs the entity type can perform to (entity type id, event type id, attributes)
+Entries are invalidated by metaevent changes made in this process and, when a SchemaListener runs, by changes made in any process
+"""
+class SchemaCache:
+    _cache = LRUCache(int(os.getenv('SCHEMA_CACHE_SIZE', 1000)), float(os.getenv('SCHEMA_CACHE_TTL', 300)))
+
+    #Incremented on every invalidation so a model loaded while it changed is not cached, the generation on every clear
+    _versions = {}
+    _generation = 0
+    _lock = threading.Lock()
+
+    """Returns the user's entity event model, loading it with the given cursor when it is not cached"""
+    @classmethod
+    def get(cls, cur, user) -> dict:
+        model = cls._cache.get(user)
+        if model is not None:
+            return model
+
+        with cls._lock:
+            version = cls._versions.get(user, 0)
+
+        cur.execute("""SELECT entity_types.name, event_types.name, entity_events.entity_type, entity_events.event_type, event_types.attrs
+        FROM entity_events
+        INNER JOIN entity_types ON entity_events.entity_type = entity_types.id
+        INNER JOIN event_types ON entity_events.event_type = event_types.id
+        WHERE entity_types.creator = %s AND event_types.creator = %s""",(user,user))
+        model = {(row[0],row[1]):(row[2],row[3],tuple(row[4] or ())) for row in cur.fetchall()}
+
+        with cls._lock:
+            if cls._versions.get(user, 0) == version:
+                cls._cache.set(user, model)
+        return model
+
+    """Returns the user's entity event model if it is cached without loading it"""
+    @classmethod
+    def peek(cls, user):
+        return cls._cache.get(user)
+
+    """Discards a user's cached model, called once a change to it has been committed"""
+    @classmethod
+    def invalidate(cls, user):
+        with cls._lock:
+            cls._versions[user] = cls._versions.get(user, 0) + 1
+            cls._cache.discard(user)
+
+    """Discards every cached model"""
+    @classmethod
+    def clear(cls):
+        with cls._lock:
+            for user in cls._versions:
+                cls._versions[user] += 1
+            cls._generation += 1
+            cls._cache.clear()
+
+    """Version of the user's model, changed by every invalidation of it"""
+    @classmethod
+    def version(cls, user):
+        with cls._lock:
+            return (cls._generation, cls._versions.get(user, 0))
+
+    """Announces a change to the user's model to every process, delivered when the cursor's transaction commits"""
+    @staticmethod
+    def notify(cur, user):
+        cur.execute("SELECT pg_notify(%s, %s)",(SCHEMA_CHANNEL,str(user)))
+
+
+"""
+Per user cache of listings of entity types and event types with the entity tag of each
+Entries hold the version of the user's model they were read at so any change to the model, announced the same way,
+makes them stale
+"""
+class ListingCache:
+    _cache = LRUCache(int(os.getenv('LISTING_CACHE_SIZE', 10000)), float(os.getenv('LISTING_CACHE_TTL', 300)))
+
+    """Returns the cached (listing, entity tag) for the key if it was read at the user's current version"""
+    @classmethod
+    def get(cls, user, key):
+        entry = cls._cache.get((user, key))
+        if entry is None or entry[0] != SchemaCache.version(user):
+            return None
+        return entry[1],entry[2]
+
+    """Caches a listing read at the given version, one read while the model changed is never returned by get"""
+    @classmethod
+    def set(cls, user, key, version, listing, etag: str):
+        cls._cache.set((user, key), (version, listing, etag))
+
+    """Strong entity tag of a listing, a hash of its content so every process tags the same listing alike"""
+    @staticmethod
+    def etag(listing) -> str:
+        return '"{0}"'.format(hashlib.sha256(json.dumps(listing, sort_keys=True, default=str).encode()).hexdigest()[:32])
+
+
+"""
+Background thread which listens for model changes announced by other processes and invalidates the local cache
+Notifications missed while disconnected are accounted for by clearing the whole cache on reconnection
+"""
+class SchemaListener(threading.Thread):
+    RECONNECT_DELAY = 5.0
+
+    def __init__(self, db_config: dict, poll_interval: float=5.0):
+        super().__init__(name='schema-listener', daemon=True)
+        #Only connection parameters are needed as the listener holds a dedicated connection outside the pool
+        self._conn_params = {key:value for key,value in db_config.items() if key not in ConnectionPool.SETTINGS}
+        self._poll_interval = poll_interval
+        self._stopped = threading.Event()
+
+    def stop(self):
+        self._stopped.set()
+
+    def run(self):
+        while not self._stopped.is_set():
+            conn = None
+            try:
+                conn = psycopg2.connect(**self._conn_params)
+                conn.autocommit = True
+                with conn.cursor() as cur:
+                    cur.execute("LISTEN {0}".format(SCHEMA_CHANNEL))
+                SchemaCache.clear()
+                self._listen(conn)
+            except DatabaseError as error:
+                print("Schema listener disconnected: {0}".format(error))
+                self._stopped.wait(self.RECONNECT_DELAY)
+            finally:
+                if conn is not None: conn.close()
+
+    def _listen(self, conn):
+        while not self._stopped.is_set():
+            if select.select([conn],[],[],self._poll_interval) == ([],[],[]):
+                continue
+            conn.poll()
+            while conn.notifies:
+                notify = conn.notifies.pop(0)
+                try:
+                    SchemaCache.invalidate(int(notify.payload))
+                except ValueError:
+                    SchemaCache.clear()
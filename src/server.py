@@ -1,12 +1,26 @@
 """Routes requests sent to the audit server and serves responses to the client"""
+import os
 import re
 import sys
 import json
+import argparse
+import threading
+from datetime import timedelta
 
+from concurrent.futures import ThreadPoolExecutor
 from http.server import BaseHTTPRequestHandler, HTTPServer
 from authorization import Authorizer
-from routes import Route
-from utils import config
+from prefork import PreforkSupervisor
+from routes import Route,configure_metrics_users
+from events import EventStream
+from schema import SchemaListener
+from partitions import PartitionMaintainer
+from rollups import RollupCompactor
+from archive import configure_archive,get_archive
+from journal import configure_journal,get_journal
+from groupcommit import configure_group_commit,get_group_committer
+from querycache import configure_query_cache
+from utils import config,close_pools
 
 
 """Request handler for the audit server"""
@@ -23,7 +37,9 @@ class AuditServerHandler(BaseHTTPRequestHandler):
     r'v1\/event_type': 'post_event_type',
     r'v1\/event_type\/[^\/]+': 'post_event_type_attributes', #v1/event_type/{name of event type}
     r'v1\/entity\/[^\/]+': 'post_entity_type_events',   #v1/entity/{name of entity type}
-    r'v1\/events': 'post_event'
+    r'v1\/schema': 'post_schema',
+    r'v1\/events': 'post_event',
+    r'v1\/events\/batch': 'post_event_batch'
     }
 
     _get_endpoints =  {
@@ -33,13 +49,12 @@ class AuditServerHandler(BaseHTTPRequestHandler):
     r'v1\/event_type': 'get_event_types',
     r'v1\/event_type\/[^\/]+': 'get_event_types', #v1/event_type/{name of event types}
     r'v1\/entities': 'get_entities',
-    r'v1\/events\/[^\/]+': 'get_events', #v1/events/{name of entity instance}
-    r'v1\/events': 'get_events'
+    r'v1\/events\/(?!stats$)[^\/]+': 'get_events', #v1/events/{name of entity instance}
+    r'v1\/events': 'get_events',
+    r'v1\/events\/stats': 'get_event_stats',
+    r'v1\/metrics': 'get_metrics'
     }
 
-    _data = {} #Data received from a request
-    _response = {} #Response to the data received 
-
     """Sends common headers"""
     def do_HEAD(self):
         self.send_response(self._response['code'])
@@ -59,8 +74,23 @@ class AuditServerHandler(BaseHTTPRequestHandler):
         self.__read_data()
         self.__navigate_endpoint_auth(self._get_endpoints)
 
+        if isinstance(self._response.get('result'), EventStream):
+            self.__write_stream(self._response['result'])
+            return
+
+        #A client whose copy is current is only sent the entity tag
+        if self._response['code'] == 304:
+            self.send_response(304)
+            self.send_header("ETag", self._etag)
+            self.send_header("Cache-Control", "private, no-cache")
+            self.end_headers()
+            return
+
         self.do_HEAD()
         self.send_header("Access-Control-Allow-Methods", "GET")        
+        if self._etag is not None:
+            self.send_header("ETag", self._etag)
+            self.send_header("Cache-Control", "private, no-cache")
         self.end_headers()
 
         self.wfile.write(bytes(json.dumps(self._response), 'utf-8'))
@@ -77,8 +107,37 @@ class AuditServerHandler(BaseHTTPRequestHandler):
         self.wfile.write(bytes(json.dumps(self._response), 'utf-8'))
 
 
-    """Reads any data sent in by a request"""
+    """
+    Writes a streamed response with chunked transfer encoding, which needs HTTP/1.1, closing the connection afterwards
+    A failure part way leaves the response without its final chunk so the client can tell it is incomplete
+    """
+    def __write_stream(self, stream: EventStream):
+        try:
+            self.protocol_version = 'HTTP/1.1'
+            self.send_response(200)
+            self.send_header("Access-Control-Allow-Origin", self.headers.get('origin'))
+            self.send_header("Access-Control-Allow-Methods", "GET")
+            self.send_header("Content-Type", stream.content_type)
+            self.send_header("Transfer-Encoding", "chunked")
+            self.send_header("Connection", "close")
+            self.end_headers()
+
+            for chunk in stream.chunks():
+                self.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+            self.wfile.write(b'0\r\n\r\n')
+
+        except Exception as error:
+            print("Event stream interrupted: {0}".format(error))
+        finally:
+            stream.close()
+
+
+    """Reads any data sent in by a request, request state is kept on the handler instance which serves a single request"""
     def __read_data(self):
+        self._data = {} #Data received from a request
+        self._response = {} #Response to the data received 
+        self._etag = None #Entity tag of the response to a conditional request
+
         content_length = self.headers.get('Content-Length')
         length = int(content_length) if content_length else 0
         data_string=self.rfile.read(length)
@@ -144,8 +203,9 @@ class AuditServerHandler(BaseHTTPRequestHandler):
         url_params = [targets[i] for i in range(2,len(targets),2)] if len(targets)>2 else []
 
         #Router class runs the function selected based on the endpoint
-        route_manager = Route(auth_manager,self._data,self.server._db_config,url_params)
+        route_manager = Route(auth_manager,self._data,self.server._db_config,url_params,self.headers)
         result,success,code = route_manager.resolve(endpoints[matched_endpoint[0]])
+        self._etag = route_manager.etag
 
         self._set_response(result,success,code)
 
@@ -158,18 +218,181 @@ class AuditServerHandler(BaseHTTPRequestHandler):
 class AuditHTTPServer(HTTPServer):
     _db_config =None
 
-    def __init__(self, address, handlerClass=AuditServerHandler):
-        super().__init__(address, handlerClass)
+    def __init__(self, address, handlerClass=AuditServerHandler, bind_and_activate=True):
+        super().__init__(address, handlerClass, bind_and_activate)
         self._db_config = config()
 
+    """Creates a server which accepts connections from an already listening socket eg. one inherited from a parent process"""
+    @classmethod
+    def from_socket(cls, listener, **kwargs):
+        server = cls(listener.getsockname(), bind_and_activate=False, **kwargs)
+        server.socket.close()
+        server.socket = listener
+        server.server_address = listener.getsockname()
+        return server
+
+    """Stops accepting requests, waits for those in flight and then stops the journal as nothing more can be appended to it"""
+    def server_close(self):
+        super().server_close()
+        self._drain_requests()
+
+        group_committer = get_group_committer()
+        if group_committer is not None:
+            group_committer.close()
+
+        journal = get_journal()
+        if journal is not None:
+            journal.close()
+
+    def _drain_requests(self):
+        pass
 
-"""Audit server initalization based on command ine arguments host and port which default to 0.0.0.0 and 8080"""
-if __name__ == "__main__":
-    host = sys.argv[1] if len(sys.argv) > 1 else '0.0.0.0'
-    port = int(sys.argv[2]) if len(sys.argv) > 2 else 8080
 
-    audit_server = AuditHTTPServer((host, port))
-    print("Audit Server initiated at http://{0}:{1}".format(host, port))
+"""
+Serves each request on a bounded pool of worker threads
+Once every worker is busy and the queue is full the accept loop blocks, leaving further clients in the listen backlog
+"""
+class ThreadPoolAuditHTTPServer(AuditHTTPServer):
+    request_queue_size = 128
+
+    def __init__(self, address, handlerClass=AuditServerHandler, bind_and_activate=True, workers=16, queue_size=64):
+        super().__init__(address, handlerClass, bind_and_activate)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='audit-worker')
+        self._slots = threading.BoundedSemaphore(workers+queue_size)
+
+    def process_request(self, request, client_address):
+        self._slots.acquire()
+        try:
+            self._executor.submit(self._process_request_thread, request, client_address)
+        except RuntimeError:
+            self._slots.release()
+            self.shutdown_request(request)
+
+    """Same as socketserver.ThreadingMixIn.process_request_thread but releases a slot once done"""
+    def _process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self._slots.release()
+
+    def _drain_requests(self):
+        self._executor.shutdown(wait=True)
+
+
+"""Parses command line arguments, host and port default to 0.0.0.0 and 8080 and the server to the single threaded mode"""
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description='Audit logging server')
+    parser.add_argument('host', nargs='?', default='0.0.0.0')
+    parser.add_argument('port', nargs='?', type=int, default=8080)
+    parser.add_argument('--mode', choices=['single','threaded','prefork'], default='single', help='How concurrent requests are served')
+    parser.add_argument('--workers', type=int, default=16, help='Worker threads in threaded mode and in each prefork process')
+    parser.add_argument('--queue-size', type=int, default=64, help='Accepted requests allowed to wait for a worker in threaded mode')
+    parser.add_argument('--processes', type=int, default=os.cpu_count(), help='Worker processes in prefork mode')
+    parser.add_argument('--drain-timeout', type=float, default=30, help='Seconds prefork workers are given to finish in flight requests on shutdown')
+    parser.add_argument('--schema-notify', action='store_true', help='Listen for entity event model changes made by other server processes, always on in prefork mode')
+    parser.add_argument('--journal-dir', help='Directory of the write-behind journal, enables asynchronous event ingestion')
+    parser.add_argument('--journal-fsync-interval', type=float, default=0.005, help='Seconds journal appends are gathered before being fsynced together')
+    parser.add_argument('--journal-batch-size', type=int, default=1000, help='Most journaled events written to the database in one transaction')
+    parser.add_argument('--group-commit-size', type=int, default=0, help='Most concurrently added events committed in one transaction, 0 commits every event on its own')
+    parser.add_argument('--group-commit-window', type=float, default=0.002, help='Seconds a group waits for more events after its first')
+    parser.add_argument('--partition-maintenance-interval', type=float, default=3600, help='Seconds between runs of the events partition maintenance, 0 disables it')
+    parser.add_argument('--archive-dir', help='Directory of the archive of old events, event views read through it')
+    parser.add_argument('--archive-after', type=float, default=0, help='Days after which partitions of events are moved into the archive, 0 only reads the archive')
+    parser.add_argument('--query-cache-size', type=float, default=0, help='Megabytes of event view results cached in each server process, 0 disables the cache')
+    parser.add_argument('--query-cache-ttl', type=float, default=60, help='Seconds a cached event view result is kept')
+    parser.add_argument('--metrics-user', type=int, action='append', help='Id of an operator allowed to view server metrics, may be given more than once')
+    parser.add_argument('--rollup-compaction-interval', type=float, default=10, help='Seconds between compactions of newly added events into the rollups read by event stats and the latest events of entity instances, 0 disables it')
+    return parser.parse_args(args)
+
+
+"""Opens the write-behind journal of a server process, each process has its own journal under the journal directory"""
+def start_journal(args, db_config, slot=0):
+    if args.journal_dir is not None:
+        directory = os.path.join(args.journal_dir, 'worker-{0}'.format(slot))
+        configure_journal(directory, db_config, fsync_interval=args.journal_fsync_interval, batch_size=args.journal_batch_size)
+
+
+"""Starts the group commit coordinator of a server process when enabled"""
+def start_group_commit(args, db_config):
+    if args.group_commit_size > 0:
+        configure_group_commit(db_config, max_size=args.group_commit_size, window=args.group_commit_window)
+
+
+"""
+Creates the event view result cache of a server process when enabled
+Prefork workers do not see each other's writes, so their cached results are only served to clients accepting their age
+"""
+def start_query_cache(args):
+    if args.query_cache_size > 0:
+        configure_query_cache(int(args.query_cache_size*1024*1024), args.query_cache_ttl, versioned=args.mode != 'prefork')
+
+
+"""Opens the archive of old events when enabled"""
+def start_archive(args):
+    if args.archive_dir is not None:
+        configure_archive(args.archive_dir)
+
+
+"""Starts the periodic events partition maintenance of the server when enabled, which also fills the archive when an age is set"""
+def start_partition_maintenance(args, db_config):
+    if args.partition_maintenance_interval > 0:
+        archive = get_archive() if args.archive_after > 0 else None
+        PartitionMaintainer(db_config, args.partition_maintenance_interval, archive, timedelta(days=args.archive_after)).start()
+
+
+"""Starts the periodic compaction of the event rollups and latest events of entity instances when enabled"""
+def start_rollup_compaction(args, db_config):
+    if args.rollup_compaction_interval > 0:
+        RollupCompactor(db_config, args.rollup_compaction_interval).start()
+
+
+"""Runs the pre-fork supervisor where each worker process serves the shared socket with its own thread pool and database pool"""
+def serve_prefork(args):
+    def make_server(listener, slot):
+        server = ThreadPoolAuditHTTPServer.from_socket(listener, workers=args.workers, queue_size=args.queue_size)
+        SchemaListener(server._db_config).start()
+        start_journal(args, server._db_config, slot)
+        start_group_commit(args, server._db_config)
+        start_query_cache(args)
+        start_archive(args)
+        configure_metrics_users(args.metrics_user)
+        if slot == 0:
+            start_partition_maintenance(args, server._db_config)
+            start_rollup_compaction(args, server._db_config)
+        return server
+
+    supervisor = PreforkSupervisor((args.host, args.port), make_server, args.processes, args.drain_timeout)
+    print("Audit Server initiated at http://{0}:{1} ({2} with {3} processes)".format(args.host, args.port, args.mode, args.processes))
+    supervisor.serve_forever()
+    print("Audit Server terminated")
+
+
+"""Audit server initalization based on command line arguments"""
+if __name__ == "__main__":
+    args = parse_args()
+
+    if args.mode == 'prefork':
+        serve_prefork(args)
+        sys.exit(0)
+
+    if args.mode == 'threaded':
+        audit_server = ThreadPoolAuditHTTPServer((args.host, args.port), workers=args.workers, queue_size=args.queue_size)
+    else:
+        audit_server = AuditHTTPServer((args.host, args.port))
+
+    if args.schema_notify:
+        SchemaListener(audit_server._db_config).start()
+    start_journal(args, audit_server._db_config)
+    start_group_commit(args, audit_server._db_config)
+    start_query_cache(args)
+    start_archive(args)
+    configure_metrics_users(args.metrics_user)
+    start_partition_maintenance(args, audit_server._db_config)
+    start_rollup_compaction(args, audit_server._db_config)
+    print("Audit Server initiated at http://{0}:{1} ({2})".format(args.host, args.port, args.mode))
 
     try:
         audit_server.serve_forever()
@@ -177,4 +400,5 @@ if __name__ == "__main__":
         pass
 
     audit_server.server_close()
+    close_pools()
     print("Audit Server terminated")
\ No newline at end of file
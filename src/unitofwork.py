@@ -0,0 +1,60 @@
+"""Transactions spanning a change and the events auditing it on a single pooled connection"""
+
+import contextlib
+from psycopg2.extensions import TRANSACTION_STATUS_INERROR
+from utils import connect,disconnect,release
+
+
+"""
+Transaction on one pooled connection shared by a change and every event added while it is made
+Committed on leaving unless an unexpected error escapes. Errors defined by the system (message,success,code) still commit,
+they are raised once the failed change has been undone by its savepoint so the events recording the failure are kept
+"""
+class UnitOfWork:
+    def __init__(self, db_config: dict):
+        self._db_config = db_config
+        self._conn = None
+        self._callbacks = []
+        self.cursor = None
+
+    def __enter__(self):
+        self._conn,self.cursor = connect(self._db_config)
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        try:
+            if self._committable(exc):
+                self._conn.commit()
+                for callback in self._callbacks:
+                    callback()
+            else:
+                self._conn.rollback()
+            disconnect(self._conn,self.cursor)
+        finally:
+            release(self._conn)
+        return False
+
+    def _committable(self, exc) -> bool:
+        if exc is not None and len(exc.args) != 3:
+            return False
+        return self._conn.info.transaction_status != TRANSACTION_STATUS_INERROR
+
+
+    """
+    Runs the enclosed statements under a savepoint so any error raised within only undoes them
+    Events recording a failure are added once the savepoint has been left
+    """
+    @contextlib.contextmanager
+    def savepoint(self):
+        self.cursor.execute("SAVEPOINT unit_of_work")
+        try:
+            yield self.cursor
+        except BaseException:
+            self.cursor.execute("ROLLBACK TO SAVEPOINT unit_of_work")
+            raise
+        self.cursor.execute("RELEASE SAVEPOINT unit_of_work")
+
+
+    """Calls the function once the unit of work has committed, such as to invalidate caches of what it changed"""
+    def on_commit(self, callback):
+        self._callbacks.append(callback)
@@ -1,8 +1,9 @@
 """List of stand alone utility functions"""
 
 import os
-import psycopg2
+import threading
 from configparser import ConfigParser
+from pool import ConnectionPool
 
 #TODO: Couple generic errors together with a success status and error code (Can be place in a separate exception hadler)
 
@@ -25,23 +26,75 @@ def config(filename=os.getenv('DATABASE_INI'), section='postgresql') -> dict:
         raise Exception('Section {0} not found in the {1} file'.format(section, filename))
     return db
 
+#Connection pools keyed by the configuration they were created from
+_pools = {}
+_pools_lock = threading.Lock()
+
+#Pool each checked out connection belongs to, keyed by the connection's id
+_checkouts = {}
+
+"""Retrieve the connection pool for a configuration, creating it on first use"""
+def get_pool(config: dict) -> ConnectionPool:
+    key = tuple(sorted(config.items()))
+    pool = _pools.get(key)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(key)
+            if pool is None:
+                pool = _pools[key] = ConnectionPool.from_config(config)
+    return pool
+
+"""Close every connection pool, called on server shutdown"""
+def close_pools():
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close()
+        _pools.clear()
+
+"""
+Forget pools inherited from a parent process so each forked worker opens its own connections
+The inherited connections are kept referenced rather than closed as closing them would end sessions the parent still uses
+"""
+_inherited_pools = []
+def _forget_inherited_pools():
+    global _pools_lock
+    _pools_lock = threading.Lock()
+    _inherited_pools.extend(_pools.values())
+    _pools.clear()
+    _checkouts.clear()
+
+os.register_at_fork(after_in_child=_forget_inherited_pools)
+
 """
-Connect to the database 
+Check out a pooled connection to the database 
+@param cursor_name: name of a server side cursor to open instead of a client side cursor
 @returns tuple[conection,cursor]
 """
-def connect(config: dict):
-    conn = psycopg2.connect(**config)
-    cur = conn.cursor()
+def connect(config: dict, cursor_name: str=None):
+    pool = get_pool(config)
+    conn = pool.getconn()
+    _checkouts[id(conn)] = pool
+    cur = conn.cursor(name=cursor_name)
     return(conn,cur) 
 
 """
-Disconnect from the database
+Return a connection to its pool, any uncommitted work is rolled back
+Safe to call more than once for the same checkout
+@param conn: connection
+"""
+def release(conn):
+    pool = _checkouts.pop(id(conn), None)
+    if pool is not None:
+        pool.putconn(conn)
+
+"""
+Disconnect from the database by closing the cursor and returning the connection to its pool
 @param conn: connection
 @param cur: cursor
 """
 def disconnect(conn,cur):
     cur.close()
-    conn.close()
+    release(conn)
 
 
 """Places each element of a tuple in a list of tuples into a dictionary where the keys are based on the labels list"""
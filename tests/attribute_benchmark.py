@@ -0,0 +1,120 @@
+"""
+Query benchmark for attribute filters of event views
+Creates a throwaway account owning a number of generated events, then times the queries event views build for
+attribute equality, IN, prefix and range filters and prints the plan Postgres chose for each
+Usage: DATABASE_INI=... python3 attribute_benchmark.py [events] [runs]
+"""
+import os
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from utils import config,connect,disconnect,release
+from events import Event
+
+
+#Filters timed, named as printed
+FILTERS = [
+    ('equality', {'status':'refunded'}),
+    ('in', {'status':{'in':['refunded','disputed']}}),
+    ('prefix', {'region':{'prefix':'ap-'}}),
+    ('range', {'amount':{'gte':9990}}),
+    ('range and equality', {'amount':{'gte':9000,'lt':9100},'status':'refunded'}),
+]
+
+
+"""Creates an account whose order events carry status, region and amount attributes, returns the user id"""
+def setup(db_config, events):
+    conn = None
+    try:
+        conn,cur = connect(db_config)
+        cur.execute("INSERT INTO users(email,password,salt) VALUES (%s,'-','-') RETURNING id",('attribute_bench_{0}@test.com'.format(uuid.uuid4().hex[:12]),))
+        user = cur.fetchone()[0]
+        cur.execute("INSERT INTO entity_types(creator,name) VALUES (%s,'account') RETURNING id",(user,))
+        entity_type = cur.fetchone()[0]
+        cur.execute("""INSERT INTO event_types(creator,name,attrs) VALUES (%s,'order',ARRAY['status','region','amount']),
+        (%s,'login',ARRAY['device']) RETURNING id""",(user,user))
+        event_types = [row[0] for row in cur.fetchall()]
+        cur.execute("INSERT INTO entity_events(entity_type,event_type) SELECT %s, unnest(%s)",(entity_type,event_types))
+        cur.execute("""INSERT INTO entity_instances(name,type,creator)
+        SELECT 'account_'||n, %s, %s FROM generate_series(1,1000) AS n""",(entity_type,user))
+
+        #One event in fifty is a refunded order and one in a hundred and fifty is disputed
+        cur.execute("""INSERT INTO events(type,creator,entity_id,time,success,data)
+        SELECT CASE WHEN n %% 4 = 0 THEN %(login)s ELSE %(order)s END, %(user)s,
+        (SELECT min(id) FROM entity_instances WHERE creator = %(user)s) + n %% 1000,
+        LOCALTIMESTAMP - make_interval(secs => n), TRUE,
+        CASE WHEN n %% 4 = 0 THEN jsonb_build_object('device', 'device_'||n %% 7)
+        ELSE jsonb_build_object(
+            'status', CASE WHEN n %% 50 = 1 THEN 'refunded' WHEN n %% 150 = 2 THEN 'disputed' ELSE 'completed' END,
+            'region', (ARRAY['eu-west-1','eu-central-1','us-east-1','us-west-2','ap-south-1'])[1 + n %% 5],
+            'amount', (n::BIGINT * 7919) %% 10000)
+        END
+        FROM generate_series(1,%(events)s) AS n""",{'login':event_types[1],'order':event_types[0],'user':user,'events':events})
+        conn.commit()
+
+        conn.autocommit = True
+        cur.execute("ANALYZE events")
+        conn.autocommit = False
+        disconnect(conn,cur)
+        return user
+    finally:
+        if conn is not None: release(conn)
+
+
+"""Removes the account and everything it owns"""
+def teardown(db_config, user):
+    conn = None
+    try:
+        conn,cur = connect(db_config)
+        cur.execute("DELETE FROM events WHERE creator = %s",(user,))
+        cur.execute("DELETE FROM entity_instances WHERE creator = %s",(user,))
+        cur.execute("DELETE FROM entity_events WHERE entity_type IN (SELECT id FROM entity_types WHERE creator = %s)",(user,))
+        cur.execute("DELETE FROM entity_types WHERE creator = %s",(user,))
+        cur.execute("DELETE FROM event_types WHERE creator = %s",(user,))
+        cur.execute("DELETE FROM users WHERE id = %s",(user,))
+        conn.commit()
+        disconnect(conn,cur)
+    finally:
+        if conn is not None: release(conn)
+
+
+"""Times the first page of an event view with the given filters, returning the median latency, the rows returned and the plan"""
+def measure(db_config, user, filters, runs):
+    query,values,_ = Event(db_config, user)._view_query(dict(filters), None, Event.DEFAULT_PAGE_SIZE)
+    conn = None
+    try:
+        conn,cur = connect(db_config)
+        latencies = []
+        for _ in range(runs):
+            start = time.monotonic()
+            cur.execute(query,values)
+            rows = len(cur.fetchall())
+            latencies.append(time.monotonic()-start)
+
+        cur.execute("EXPLAIN (ANALYZE, BUFFERS) "+query,values)
+        plan = [row[0] for row in cur.fetchall()]
+        disconnect(conn,cur)
+    finally:
+        if conn is not None: release(conn)
+
+    latencies.sort()
+    return latencies[len(latencies)//2],rows,plan
+
+
+if __name__ == "__main__":
+    events = int(sys.argv[1]) if len(sys.argv) > 1 else 2000000
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+
+    db_config = config()
+    user = setup(db_config, events)
+    try:
+        print("Events: {0}, runs per filter: {1}".format(events, runs))
+        for name,filters in FILTERS:
+            latency,rows,plan = measure(db_config, user, filters, runs)
+            print("\n{0}: {1} rows, median {2:.1f} ms".format(name, rows, latency*1000))
+            print("\n".join('  '+line for line in plan))
+    finally:
+        teardown(db_config, user)
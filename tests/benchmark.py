@@ -0,0 +1,101 @@
+"""
+Throughput benchmark for a running audit server
+Registers a fresh account, sets up an entity type able to perform one event type
+and then has a number of concurrent clients repeatedly hit an endpoint for a fixed duration
+Usage: python3 benchmark.py [base_url] [clients] [seconds] [scenario]
+Scenarios:
+post_event: POST v1/events
+hot_entity: POST v1/events with every client adding events to the same entity instance
+get_entities: GET v1/entities
+mixed: Alternates POST v1/events with GET v1/events/{entity} while one client in ten generates tokens (basic auth)
+"""
+import requests
+import base64
+import time
+import uuid
+import sys
+import threading
+
+
+"""Creates an account with a token and the entity/event types used by the scenarios, returns the token and basic auth key"""
+def setup(base_url):
+    email = 'bench_{0}@test.com'.format(uuid.uuid4().hex[:12])
+    requests.post(base_url+'registration', json={'email':email,'password':'password'})
+    basic = base64.b64encode('{0}:password'.format(email).encode()).decode()
+
+    token = requests.get(base_url+'new_token', json={'name':'bench'}, headers={'Authorization':'Basic '+basic}).json()['result']['token']
+    headers = {'Authorization':'Bearer '+token}
+    requests.post(base_url+'v1/entity', json={'name':'bench_entity'}, headers=headers)
+    requests.post(base_url+'v1/event_type', json={'name':'bench_event'}, headers=headers)
+    requests.post(base_url+'v1/event_type/bench_event', json={'to_add':['value']}, headers=headers)
+    requests.post(base_url+'v1/entity/bench_entity', json={'to_add':['bench_event']}, headers=headers)
+    return token,basic
+
+
+"""Returns a function performing one request of the scenario for the given client"""
+def scenario_request(scenario, base_url, token, basic, client):
+    session = requests.Session()
+    bearer = {'Authorization':'Bearer '+token}
+    event = {'event_type':'bench_event','entity_type':'bench_entity','success':True,'entity_name':'entity_{0}'.format(client),'value':client}
+    counter = [0]
+
+    def post_event():
+        return session.post(base_url+'v1/events', json=event, headers=bearer)
+
+    def hot_entity():
+        return session.post(base_url+'v1/events', json=dict(event, entity_name='hot_entity'), headers=bearer)
+
+    def get_entities():
+        return session.get(base_url+'v1/entities', headers=bearer)
+
+    def mixed():
+        counter[0] += 1
+        if client % 10 == 0:
+            return session.get(base_url+'new_token', json={'name':'bench'}, headers={'Authorization':'Basic '+basic})
+        if counter[0] % 2:
+            return post_event()
+        return session.get(base_url+'v1/events/'+event['entity_name'], headers=bearer)
+
+    return {'post_event':post_event,'hot_entity':hot_entity,'get_entities':get_entities,'mixed':mixed}[scenario]
+
+
+"""Runs the clients until the duration has passed, returning the latency of every request and the number of failures"""
+def run(scenario, base_url, clients, seconds):
+    token,basic = setup(base_url)
+    latencies = []
+    failures = [0]
+    lock = threading.Lock()
+    deadline = time.monotonic() + seconds
+
+    def client_loop(client):
+        request = scenario_request(scenario, base_url, token, basic, client)
+        while time.monotonic() < deadline:
+            start = time.monotonic()
+            try:
+                ok = request().status_code < 500
+            except requests.RequestException:
+                ok = False
+            with lock:
+                latencies.append(time.monotonic()-start)
+                failures[0] += not ok
+
+    threads = [threading.Thread(target=client_loop, args=(client,)) for client in range(clients)]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    return latencies,failures[0]
+
+
+if __name__ == "__main__":
+    base_url = sys.argv[1] if len(sys.argv) > 1 else 'http://localhost:8080/'
+    clients = int(sys.argv[2]) if len(sys.argv) > 2 else 16
+    seconds = float(sys.argv[3]) if len(sys.argv) > 3 else 10
+    scenario = sys.argv[4] if len(sys.argv) > 4 else 'post_event'
+
+    latencies,failures = run(scenario, base_url, clients, seconds)
+    latencies.sort()
+
+    print("Scenario: {0}, clients: {1}, duration: {2}s".format(scenario, clients, seconds))
+    print("Requests: {0}, failed: {1}".format(len(latencies), failures))
+    print("Throughput: {0:.1f} req/s".format(len(latencies)/seconds))
+    if latencies:
+        print("Latency p50: {0:.1f} ms, p99: {1:.1f} ms".format(latencies[len(latencies)//2]*1000, latencies[int(len(latencies)*0.99)]*1000))